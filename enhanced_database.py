@@ -1,9 +1,21 @@
+import json
 import time
+import hashlib
 import asyncio
+import contextvars
+import copy
+import functools
+import random
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from typing import Dict, List, Any, Optional, Union
+from requests import Session
+from requests.adapters import HTTPAdapter
 from appwrite.client import Client
 from appwrite.services.databases import Databases
 from appwrite.exception import AppwriteException
+from enhanced_logging import log_event
 
 # تنظیمات Appwrite
 APPWRITE_ENDPOINT = ""
@@ -11,17 +23,311 @@ APPWRITE_PROJECT_ID = ""
 APPWRITE_API_KEY = ""
 APPWRITE_DATABASE_ID = ""
 APPWRITE_COLLECTION_ID = ""
+APPWRITE_SUMMARIES_COLLECTION_ID = ""
+
+# فشرده‌سازی تاریخچه: نوبت‌های قدیمی هر chat در یک سند خلاصه تجمیع می‌شوند
+COMPACTION_KEEP_RECENT = 10  # تعداد نوبت‌های اخیر که به صورت خام نگه داشته می‌شوند
+COMPACTION_BATCH_SIZE = 50  # حداکثر نوبت‌هایی که در هر اجرا برای یک chat خلاصه می‌شوند
+COMPACTION_SCAN_LIMIT = 100  # اندازه هر صفحه از اسناد مکالمه که برای یافتن chatهای نیازمند فشرده‌سازی پیمایش می‌شود
+COMPACTION_MAX_SCAN_PAGES = 20  # حداکثر صفحات پیمایش شده در هر اجرا
+COMPACTION_MAX_CHATS = 5  # حداکثر chatهای فشرده شده در هر اجرا
+SUMMARY_MAX_CHARS = 4000
+
+try:
+    from appwrite.encoders.value_class_encoder import ValueClassEncoder
+except ImportError:  # نسخه‌های قدیمی SDK
+    ValueClassEncoder = None
+
+class KeepAliveClient(Client):
+    """کلاینت Appwrite که درخواست‌ها را از طریق یک HTTP session مشترک با keep-alive ارسال می‌کند
+    
+    Client اصلی SDK برای هر درخواست requests.request صدا می‌زند که هر بار
+    اتصال TCP/TLS جدید می‌سازد؛ این کلاس سوکت‌های گرم را بین درخواست‌ها نگه می‌دارد.
+    """
+    
+    def __init__(self, session, timeout=None):
+        super().__init__()
+        self._session = session
+        self._timeout = timeout
+    
+    def call(self, method, path='', headers=None, params=None, response_type='json'):
+        if headers is None:
+            headers = {}
+        if params is None:
+            params = {}
+        
+        headers = {**self._global_headers, **headers}
+        
+        # آپلود فایل (multipart) را به پیاده‌سازی اصلی SDK می‌سپاریم
+        if headers.get('content-type', '').startswith('multipart/form-data'):
+            return super().call(method, path, headers, params, response_type)
+        
+        params = {k: v for k, v in params.items() if v is not None}
+        data = None
+        if method != 'get':
+            data = json.dumps(params, cls=ValueClassEncoder)
+            params = {}
+        
+        response = None
+        try:
+            response = self._session.request(
+                method=method,
+                url=self._endpoint + path,
+                params=self.flatten(params),
+                data=data,
+                headers=headers,
+                verify=(not self._self_signed),
+                allow_redirects=(response_type != 'location'),
+                timeout=self._timeout
+            )
+            response.raise_for_status()
+            
+            if response_type == 'location':
+                return response.headers.get('Location')
+            
+            if response.headers.get('Content-Type', '').startswith('application/json'):
+                return response.json()
+            return response.content
+            
+        except Exception as e:
+            if response is None:
+                raise AppwriteException(str(e))
+            
+            if response.headers.get('Content-Type', '').startswith('application/json'):
+                body = response.json()
+                raise AppwriteException(body.get('message'), response.status_code, body.get('type'), response.text)
+            raise AppwriteException(response.text, response.status_code, None, response.text)
+
+class DeadlineExceeded(Exception):
+    """بودجه زمانی درخواست تمام شده است"""
+
+
+class Deadline:
+    """بودجه زمانی یک درخواست که از main تا تمام فراخوانی‌ها منتقل می‌شود
+    
+    reserve بخشی از بودجه است که برای مسیر خطا (مثل save_failed_message) کنار
+    گذاشته می‌شود و فراخوانی‌های عادی از آن استفاده نمی‌کنند.
+    """
+    
+    def __init__(self, budget, reserve=0.0):
+        self.expires_at = time.monotonic() + budget
+        self.reserve = reserve
+    
+    def remaining(self):
+        """زمان باقی‌مانده (بدون احتساب reserve)"""
+        return max(0.0, self.expires_at - time.monotonic() - self.reserve)
+    
+    def expired(self):
+        return self.remaining() <= 0
+    
+    def timeout(self, cap):
+        """timeout یک فراخوانی: کمترین مقدار بین cap و زمان باقی‌مانده"""
+        return min(cap, self.remaining())
+    
+    def for_failure_path(self):
+        """همین deadline با آزاد شدن reserve، برای مسیر ذخیره خطا"""
+        deadline = Deadline(0)
+        deadline.expires_at = self.expires_at
+        return deadline
+
+class RetryBudget:
+    """بودجه retry در سطح process (token bucket متناسب با فراخوانی‌های موفق)
+    
+    هر فراخوانی موفق ratio توکن اضافه می‌کند و هر retry یک توکن مصرف می‌کند؛
+    در زمان قطعی Appwrite بودجه خالی می‌شود و retryها قطع می‌شوند تا
+    بار اضافه روی سرویس آسیب‌دیده ایجاد نشود.
+    """
+    
+    def __init__(self, ratio=0.1, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = float(max_tokens)
+        self._lock = threading.Lock()
+        self.stats = {'retries_allowed': 0, 'retries_denied': 0}
+    
+    def record_success(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+    
+    def try_acquire(self):
+        """برداشت یک توکن برای retry؛ False یعنی بودجه تمام شده است"""
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.stats['retries_allowed'] += 1
+                return True
+            self.stats['retries_denied'] += 1
+            return False
+    
+    def get_stats(self):
+        with self._lock:
+            return {'tokens': round(self._tokens, 2), 'max_tokens': self.max_tokens, **self.stats}
+
+class QueryCache:
+    """کش نتایج خواندن (get_document/list_documents) با TTL و حذف LRU
+    
+    عملیات نوشتن روی یک collection، نتایج list آن collection و نتیجه get همان
+    document را نامعتبر می‌کنند. شمارنده generation هر collection جلوی ذخیره
+    نتیجه‌ای را می‌گیرد که قبل از یک نوشتن همزمان خوانده شده است.
+    """
+    
+    MISS = object()
+    
+    def __init__(self, ttl=30, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+    
+    @staticmethod
+    def make_key(operation, params):
+        """ساخت کلید کش از عملیات، collection و queryهای نرمال‌شده"""
+        queries = [query.strip() for query in params.get('queries') or []]
+        # ترتیب فیلترها اهمیتی ندارد، ولی ترتیب order ها مهم است
+        orders = tuple(q for q in queries if 'orderAsc' in q or 'orderDesc' in q)
+        filters = tuple(sorted(q for q in queries if q not in orders))
+        return (
+            operation,
+            params.get('database_id'),
+            params.get('collection_id'),
+            params.get('document_id'),
+            filters,
+            orders
+        )
+    
+    def get(self, key):
+        """دریافت نتیجه از کش (یا MISS)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['expires_at'] < time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.stats['misses'] += 1
+                return self.MISS
+            
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return copy.deepcopy(entry['result'])
+    
+    def generation(self, collection_id):
+        """شمارنده نوشتن‌های یک collection"""
+        with self._lock:
+            return self._generations.get(collection_id, 0)
+    
+    def put(self, key, result, generation):
+        """ذخیره نتیجه در کش (اگر در این فاصله نوشتنی روی collection انجام نشده باشد)"""
+        collection_id = key[2]
+        with self._lock:
+            if self._generations.get(collection_id, 0) != generation:
+                return
+            
+            self._entries[key] = {
+                'result': copy.deepcopy(result),
+                'expires_at': time.time() + self.ttl
+            }
+            self._entries.move_to_end(key)
+            
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+    
+    def invalidate(self, collection_id, document_id=None):
+        """نامعتبر کردن نتایج list یک collection و نتیجه get یک document"""
+        with self._lock:
+            self._generations[collection_id] = self._generations.get(collection_id, 0) + 1
+            
+            for key in list(self._entries):
+                operation, _, key_collection, key_document = key[:4]
+                if key_collection != collection_id:
+                    continue
+                if operation == 'list_documents' or key_document == document_id:
+                    del self._entries[key]
+                    self.stats['invalidations'] += 1
+    
+    def get_stats(self):
+        """آمار کش برای monitoring"""
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                **self.stats,
+                'hit_ratio': self.stats['hits'] / lookups if lookups else 0
+            }
 
 class EnhancedDatabaseConnection:
     """کلاس مدیریت اتصال بهبود یافته به دیتابیس Appwrite با قابلیت‌های real-time"""
     
     _instance = None
     _connection_pool = {}
-    _max_connections = 10
+    _min_connections = 2
+    _max_connections = 20
     _connection_timeout = 30
     _retry_attempts = 3
+    _retry_backoff_base = 0.5
+    _retry_backoff_cap = 4
+    _retry_budget = RetryBudget(ratio=0.1, max_tokens=10)
     _last_health_check = 0
     _health_check_interval = 300  # 5 دقیقه
+    _pool_lock = threading.RLock()
+    _pool_available = threading.Condition(_pool_lock)
+    
+    # تنظیمات اندازه پویای pool
+    _max_wait_time = 10  # حداکثر 10 ثانیه انتظار برای اتصال آزاد
+    _idle_eviction_timeout = 120  # اتصالی که 2 دقیقه بیکار بماند حذف می‌شود
+    _eviction_check_interval = 15
+    _last_eviction_check = 0
+    _next_connection_index = 0
+    _recent_wait = 0.0  # میانگین اخیر انتظار برای اتصال (سیگنال بار برای کنترل پذیرش)
+    _recent_wait_at = 0.0
+    _wait_signal_half_life = 10  # میانگین در نبود انتظار جدید هر 10 ثانیه نصف می‌شود
+    
+    # تنظیمات HTTP session مشترک (keep-alive) برای تمام اتصالات pool
+    _http_session = None
+    _http_pool_connections = 2  # تعداد hostهایی که سوکت‌هایشان نگه داشته می‌شود
+    _http_pool_maxsize = _max_connections  # حداکثر سوکت باز برای هر host
+    _http_timeout = (5, 30)  # (connect, read) به ثانیه
+    _pool_stats = {
+        'checkouts': 0,
+        'waited_checkouts': 0,
+        'wait_timeouts': 0,
+        'total_wait_time': 0.0,
+        'max_wait_time': 0.0,
+        'grown': 0,
+        'evicted': 0,
+        'peak_size': 0
+    }
+    
+    # تنظیمات hedged reads (به صورت پیش‌فرض غیرفعال، فقط برای عملیات idempotent)
+    _hedging_enabled = False
+    _hedgeable_operations = ('get_document', 'list_documents')
+    _hedge_percentile = 0.95
+    _hedge_min_delay = 0.05
+    _hedge_default_delay = 0.5  # تا زمانی که نمونه کافی از latency نداریم
+    _hedge_min_samples = 20
+    _hedge_budget_ratio = 0.1  # هر درخواست 0.1 توکن به بودجه hedge اضافه می‌کند
+    _hedge_budget_max = 5
+    _hedge_budget_tokens = 0.0
+    _hedge_executor = None
+    _latency_window = 200
+    _latency_samples = {}
+    _hedge_stats = {'requests': 0, 'hedges_sent': 0, 'hedges_won': 0, 'budget_denied': 0}
+    
+    # کش نتایج خواندن (به صورت پیش‌فرض غیرفعال؛ با configure_query_cache فعال می‌شود)
+    _query_cache = None
+    _cacheable_operations = ('get_document', 'list_documents')
+    _write_operations = ('create_document', 'update_document', 'delete_document')
+    _bulk_max_parallel = 5  # حداکثر عملیات همزمان در execute_many
+    _operation_arg_names = {
+        'create_document': ('database_id', 'collection_id', 'document_id', 'data'),
+        'get_document': ('database_id', 'collection_id', 'document_id', 'queries'),
+        'update_document': ('database_id', 'collection_id', 'document_id', 'data'),
+        'delete_document': ('database_id', 'collection_id', 'document_id'),
+        'list_documents': ('database_id', 'collection_id', 'queries')
+    }
     
     def __new__(cls):
         """پیاده‌سازی الگوی Singleton برای مدیریت اتصالات"""
@@ -33,175 +339,522 @@ class EnhancedDatabaseConnection:
     def _initialize(self):
         """راه‌اندازی اولیه کلاس"""
         self._create_connection_pool()
-        print("Enhanced Database Connection initialized successfully")
+        log_event('db.initialized')
     
     def _create_connection_pool(self):
-        """ایجاد pool اتصالات برای بهبود عملکرد"""
+        """ایجاد pool اتصالات با حداقل تعداد اتصال (بقیه در صورت نیاز ساخته می‌شوند)"""
         try:
-            for i in range(self._max_connections):
-                client = Client()
-                client.set_endpoint(APPWRITE_ENDPOINT)
-                client.set_project(APPWRITE_PROJECT_ID)
-                client.set_key(APPWRITE_API_KEY)
-                
-                self._connection_pool[f"conn_{i}"] = {
-                    'client': client,
-                    'databases': Databases(client),
-                    'in_use': False,
-                    'created_at': time.time(),
-                    'last_used': time.time(),
-                    'error_count': 0
-                }
+            with self._pool_lock:
+                for i in range(self._min_connections):
+                    self._add_connection()
             
-            print(f"Connection pool created with {self._max_connections} connections")
+            log_event('db.pool.created', size=self._min_connections, max_size=self._max_connections)
             
         except Exception as e:
-            print(f"Error creating connection pool: {e}")
+            log_event('db.pool.create_failed', level='error', error=str(e))
             raise AppwriteException(f"Failed to initialize database connections: {e}")
     
-    def _get_available_connection(self):
+    @classmethod
+    def _get_http_session(cls):
+        """دریافت HTTP session مشترک (در اولین استفاده ساخته می‌شود)"""
+        with cls._pool_lock:
+            if cls._http_session is None:
+                session = Session()
+                adapter = HTTPAdapter(
+                    pool_connections=cls._http_pool_connections,
+                    pool_maxsize=cls._http_pool_maxsize,
+                    max_retries=0  # retry در execute_with_retry انجام می‌شود
+                )
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                cls._http_session = session
+            return cls._http_session
+    
+    @classmethod
+    def _create_client(cls):
+        """ساخت کلاینت Appwrite روی HTTP session مشترک"""
+        client = KeepAliveClient(cls._get_http_session(), timeout=cls._http_timeout)
+        client.set_endpoint(APPWRITE_ENDPOINT)
+        client.set_project(APPWRITE_PROJECT_ID)
+        client.set_key(APPWRITE_API_KEY)
+        return client
+    
+    def _add_connection(self):
+        """افزودن یک اتصال جدید به pool (باید با نگه داشتن _pool_lock صدا زده شود)"""
+        client = self._create_client()
+        
+        conn_id = f"conn_{self._next_connection_index}"
+        self._next_connection_index += 1
+        
+        self._connection_pool[conn_id] = {
+            'client': client,
+            'databases': Databases(client),
+            'in_use': False,
+            'created_at': time.time(),
+            'last_used': time.time(),
+            'error_count': 0
+        }
+        
+        self._pool_stats['peak_size'] = max(self._pool_stats['peak_size'], len(self._connection_pool))
+        return conn_id
+    
+    def _grow_pool(self):
+        """بزرگ کردن pool به جای انتظار برای اتصال آزاد"""
+        try:
+            conn_id = self._add_connection()
+            self._pool_stats['grown'] += 1
+            log_event('db.pool.grow', size=len(self._connection_pool))
+            return conn_id
+        except Exception as e:
+            log_event('db.pool.grow_failed', level='error', error=str(e))
+            return None
+    
+    def _get_available_connection(self, max_wait=None):
         """دریافت اتصال آزاد از pool"""
         current_time = time.time()
         
         # جستجو برای اتصال آزاد
-        for conn_id, conn_info in self._connection_pool.items():
-            if not conn_info['in_use']:
-                # بررسی timeout اتصال
-                if current_time - conn_info['last_used'] > self._connection_timeout:
-                    self._refresh_connection(conn_id)
-                
-                conn_info['in_use'] = True
-                conn_info['last_used'] = current_time
-                return conn_id, conn_info['databases']
+        with self._pool_lock:
+            self._pool_stats['checkouts'] += 1
+            
+            for conn_id, conn_info in self._connection_pool.items():
+                if not conn_info['in_use']:
+                    # بررسی timeout اتصال
+                    if current_time - conn_info['last_used'] > self._connection_timeout:
+                        self._refresh_connection(conn_id)
+                    
+                    conn_info['in_use'] = True
+                    conn_info['last_used'] = current_time
+                    return conn_id, conn_info['databases']
+            
+            # اگر هنوز به سقف pool نرسیده‌ایم، به جای انتظار اتصال جدید می‌سازیم
+            if len(self._connection_pool) < self._max_connections:
+                conn_id = self._grow_pool()
+                if conn_id:
+                    conn_info = self._connection_pool[conn_id]
+                    conn_info['in_use'] = True
+                    return conn_id, conn_info['databases']
         
         # اگر اتصال آزاد نبود، منتظر می‌مانیم
-        return self._wait_for_connection()
+        return self._wait_for_connection(max_wait)
     
     def _refresh_connection(self, conn_id):
-        """تازه‌سازی اتصال منقضی شده"""
-        try:
-            client = Client()
-            client.set_endpoint(APPWRITE_ENDPOINT)
-            client.set_project(APPWRITE_PROJECT_ID)
-            client.set_key(APPWRITE_API_KEY)
-            
-            self._connection_pool[conn_id].update({
-                'client': client,
-                'databases': Databases(client),
-                'created_at': time.time(),
-                'error_count': 0
-            })
-            
-            print(f"Connection {conn_id} refreshed successfully")
-            
-        except Exception as e:
-            print(f"Error refreshing connection {conn_id}: {e}")
-            # در صورت خطا، اتصال را غیرفعال می‌کنیم
-            self._connection_pool[conn_id]['error_count'] += 1
+        """تازه‌سازی وضعیت منطقی اتصال (سوکت‌های گرم session مشترک حفظ می‌شوند)"""
+        if conn_id not in self._connection_pool:
+            return  # اتصال در این فاصله از pool حذف شده است
+        
+        self._connection_pool[conn_id].update({
+            'created_at': time.time(),
+            'error_count': 0
+        })
+        
+        log_event('db.pool.refresh', conn_id=conn_id)
     
-    def _wait_for_connection(self):
+    def _wait_for_connection(self, max_wait=None):
         """انتظار برای آزاد شدن اتصال"""
-        max_wait = 10  # حداکثر 10 ثانیه انتظار
-        wait_time = 0.1
-        total_wait = 0
+        started_at = time.time()
+        deadline = started_at + (self._max_wait_time if max_wait is None else max_wait)
         
-        while total_wait < max_wait:
-            for conn_id, conn_info in self._connection_pool.items():
-                if not conn_info['in_use'] and conn_info['error_count'] < 5:
-                    conn_info['in_use'] = True
-                    conn_info['last_used'] = time.time()
-                    return conn_id, conn_info['databases']
+        with self._pool_available:
+            while True:
+                for conn_id, conn_info in self._connection_pool.items():
+                    if not conn_info['in_use'] and conn_info['error_count'] < 5:
+                        conn_info['in_use'] = True
+                        conn_info['last_used'] = time.time()
+                        self._record_wait(time.time() - started_at)
+                        return conn_id, conn_info['databases']
+                
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._pool_available.wait(remaining)
             
-            time.sleep(wait_time)
-            total_wait += wait_time
+            self._record_wait(time.time() - started_at)
+            self._pool_stats['wait_timeouts'] += 1
         
         raise AppwriteException("All database connections are busy or failed")
     
+    def _record_wait(self, wait_time):
+        """ثبت زمان انتظار برای گرفتن اتصال"""
+        self._pool_stats['waited_checkouts'] += 1
+        self._pool_stats['total_wait_time'] += wait_time
+        self._pool_stats['max_wait_time'] = max(self._pool_stats['max_wait_time'], wait_time)
+        self._recent_wait = self.get_recent_wait() * 0.8 + wait_time * 0.2
+        self._recent_wait_at = time.time()
+    
+    def get_recent_wait(self):
+        """میانگین اخیر زمان انتظار برای اتصال که با گذشت زمان کاهش می‌یابد"""
+        elapsed = time.time() - self._recent_wait_at
+        return self._recent_wait * 0.5 ** (elapsed / self._wait_signal_half_life)
+    
     def _release_connection(self, conn_id):
         """آزاد کردن اتصال برای استفاده مجدد"""
-        if conn_id in self._connection_pool:
-            self._connection_pool[conn_id]['in_use'] = False
+        with self._pool_lock:
+            if conn_id in self._connection_pool:
+                # timeout کوتاه شده بر اساس deadline نباید به استفاده بعدی (مثل health_check) برسد
+                self._connection_pool[conn_id]['client']._timeout = self._http_timeout
+                self._connection_pool[conn_id]['in_use'] = False
+                self._pool_available.notify()
+            
+            if time.time() - self._last_eviction_check > self._eviction_check_interval:
+                self._evict_idle_connections()
+    
+    def _evict_idle_connections(self):
+        """حذف اتصالاتی که مدت طولانی بیکار مانده‌اند (تا حداقل اندازه pool)"""
+        current_time = time.time()
+        evicted_count = 0
+        
+        with self._pool_lock:
+            self._last_eviction_check = current_time
+            
+            for conn_id, conn_info in list(self._connection_pool.items()):
+                if len(self._connection_pool) <= self._min_connections:
+                    break
+                
+                idle_time = current_time - conn_info['last_used']
+                if not conn_info['in_use'] and idle_time > self._idle_eviction_timeout:
+                    del self._connection_pool[conn_id]
+                    evicted_count += 1
+            
+            self._pool_stats['evicted'] += evicted_count
+        
+        if evicted_count > 0:
+            log_event('db.pool.evict', evicted=evicted_count, size=len(self._connection_pool))
+        
+        return evicted_count
     
     def _handle_connection_error(self, conn_id, error):
         """مدیریت خطاهای اتصال"""
-        if conn_id in self._connection_pool:
-            self._connection_pool[conn_id]['error_count'] += 1
-            self._connection_pool[conn_id]['in_use'] = False
+        with self._pool_lock:
+            if conn_id in self._connection_pool:
+                self._connection_pool[conn_id]['error_count'] += 1
+                self._connection_pool[conn_id]['in_use'] = False
+                
+                # اگر خطاها زیاد شد، اتصال را تازه‌سازی می‌کنیم
+                if self._connection_pool[conn_id]['error_count'] >= 3:
+                    log_event('db.connection.unhealthy', level='warning', conn_id=conn_id,
+                              error_count=self._connection_pool[conn_id]['error_count'])
+                    self._refresh_connection(conn_id)
+    
+    def _execute_operation(self, databases, operation, args, kwargs):
+        """اجرای یک عملیات روی سرویس Databases"""
+        if operation == 'create_document':
+            return databases.create_document(*args, **kwargs)
+        elif operation == 'get_document':
+            return databases.get_document(*args, **kwargs)
+        elif operation == 'update_document':
+            return databases.update_document(*args, **kwargs)
+        elif operation == 'delete_document':
+            return databases.delete_document(*args, **kwargs)
+        elif operation == 'list_documents':
+            return databases.list_documents(*args, **kwargs)
+        else:
+            raise ValueError(f"Unknown operation: {operation}")
+    
+    def _execute_attempt(self, operation, args, kwargs, deadline=None):
+        """یک تلاش کامل روی یک اتصال از pool (گرفتن، اجرا، آزادسازی)"""
+        conn_id = None
+        try:
+            if deadline is not None and deadline.expired():
+                raise DeadlineExceeded("Request deadline exceeded before database call")
+            
+            max_wait = deadline.timeout(self._max_wait_time) if deadline is not None else None
+            conn_id, databases = self._get_available_connection(max_wait)
+            self._connection_pool[conn_id]['client']._timeout = self._get_call_timeout(deadline)
+            
+            started_at = time.time()
+            result = self._execute_operation(databases, operation, args, kwargs)
+            self._record_latency(operation, time.time() - started_at)
+            
+            # در صورت موفقیت، خطاهای اتصال را ریست می‌کنیم
+            if conn_id in self._connection_pool:
+                self._connection_pool[conn_id]['error_count'] = 0
+            
+            return result
+            
+        except Exception as e:
+            # فقط خطاهای گذرا (شبکه/سرور) به حساب سلامت اتصال نوشته می‌شوند، نه 404/401/403
+            if conn_id and isinstance(e, AppwriteException) and self._is_retryable_error(e):
+                self._handle_connection_error(conn_id, e)
+            raise
             
-            # اگر خطاها زیاد شد، اتصال را تازه‌سازی می‌کنیم
-            if self._connection_pool[conn_id]['error_count'] >= 3:
-                print(f"Connection {conn_id} has too many errors, refreshing...")
-                self._refresh_connection(conn_id)
+        finally:
+            if conn_id:
+                self._release_connection(conn_id)
+    
+    def _get_call_timeout(self, deadline):
+        """timeout فراخوانی HTTP بر اساس بودجه باقی‌مانده درخواست"""
+        if deadline is None:
+            return self._http_timeout
+        
+        remaining = deadline.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("Request deadline exceeded while waiting for a connection")
+        
+        connect_timeout, read_timeout = self._http_timeout
+        return (min(connect_timeout, remaining), min(read_timeout, remaining))
+    
+    def _record_latency(self, operation, duration):
+        """ثبت latency عملیات برای محاسبه تأخیر hedge"""
+        with self._pool_lock:
+            samples = self._latency_samples.get(operation)
+            if samples is None:
+                samples = deque(maxlen=self._latency_window)
+                self._latency_samples[operation] = samples
+            samples.append(duration)
+    
+    def _get_hedge_delay(self, operation):
+        """محاسبه تأخیر ارسال درخواست دوم بر اساس percentile latency"""
+        with self._pool_lock:
+            samples = sorted(self._latency_samples.get(operation, ()))
+        
+        if len(samples) < self._hedge_min_samples:
+            return self._hedge_default_delay
+        
+        index = min(len(samples) - 1, int(len(samples) * self._hedge_percentile))
+        return max(self._hedge_min_delay, samples[index])
     
-    def execute_with_retry(self, operation, *args, **kwargs):
-        """اجرای عملیات با retry logic و مدیریت خطا"""
+    def _acquire_hedge_budget(self):
+        """برداشت یک توکن از بودجه hedge (برای محدود کردن بار اضافه)"""
+        with self._pool_lock:
+            if self._hedge_budget_tokens >= 1:
+                self._hedge_budget_tokens -= 1
+                self._hedge_stats['hedges_sent'] += 1
+                return True
+            self._hedge_stats['budget_denied'] += 1
+            return False
+    
+    def _get_hedge_executor(self):
+        """executor مشترک برای اجرای درخواست‌های hedge شده"""
+        with self._pool_lock:
+            if self._hedge_executor is None:
+                EnhancedDatabaseConnection._hedge_executor = ThreadPoolExecutor(
+                    max_workers=self._max_connections * 2,
+                    thread_name_prefix='db-hedge'
+                )
+            return self._hedge_executor
+    
+    def _execute_hedged(self, operation, args, kwargs, deadline=None):
+        """اجرای عملیات idempotent با hedging: اولین پاسخ برنده است"""
+        with self._pool_lock:
+            self._hedge_stats['requests'] += 1
+            self._hedge_budget_tokens = min(
+                self._hedge_budget_max,
+                self._hedge_budget_tokens + self._hedge_budget_ratio
+            )
+        
+        executor = self._get_hedge_executor()
+        primary = executor.submit(
+            contextvars.copy_context().run, self._execute_attempt, operation, args, kwargs, deadline
+        )
+        
+        hedge_delay = self._get_hedge_delay(operation)
+        if deadline is not None:
+            hedge_delay = deadline.timeout(hedge_delay)
+        
+        done, _ = wait([primary], timeout=hedge_delay)
+        if done or not self._acquire_hedge_budget():
+            return primary.result()
+        
+        # درخواست اول کند است؛ درخواست دوم روی اتصال دیگری از pool ارسال می‌شود
+        hedge = executor.submit(
+            contextvars.copy_context().run, self._execute_attempt, operation, args, kwargs, deadline
+        )
+        pending = {primary, hedge}
+        last_exception = None
+        
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    last_exception = e
+                    continue
+                
+                # درخواست بازنده لغو می‌شود؛ اگر در حال اجرا باشد، نتیجه‌اش نادیده گرفته می‌شود
+                for loser in pending:
+                    loser.cancel()
+                if future is hedge:
+                    with self._pool_lock:
+                        self._hedge_stats['hedges_won'] += 1
+                return result
+        
+        raise last_exception
+    
+    def configure_hedging(self, enabled=True, percentile=None, min_delay=None, budget_ratio=None):
+        """فعال‌سازی hedged reads برای get_document و list_documents"""
+        self._hedging_enabled = enabled
+        if percentile is not None:
+            self._hedge_percentile = percentile
+        if min_delay is not None:
+            self._hedge_min_delay = min_delay
+        if budget_ratio is not None:
+            self._hedge_budget_ratio = budget_ratio
+    
+    def configure_query_cache(self, enabled=True, ttl=30, max_entries=256):
+        """فعال‌سازی کش نتایج get_document و list_documents"""
+        self._query_cache = QueryCache(ttl=ttl, max_entries=max_entries) if enabled else None
+    
+    def _operation_params(self, operation, args, kwargs):
+        """تبدیل آرگومان‌های positional عملیات به پارامترهای نام‌دار"""
+        params = dict(zip(self._operation_arg_names.get(operation, ()), args))
+        params.update(kwargs)
+        return params
+    
+    def execute_with_retry(self, operation, *args, hedge=None, cache=None, deadline=None, **kwargs):
+        """اجرای عملیات با retry logic و مدیریت خطا
+        
+        hedge: برای عملیات idempotent، در صورت کند بودن درخواست اول یک درخواست
+        دوم ارسال می‌شود. None یعنی استفاده از تنظیمات کلی (configure_hedging).
+        cache: با False، خواندن مستقیم از Appwrite انجام می‌شود حتی اگر کش فعال باشد.
+        deadline: انتظار برای اتصال، timeout فراخوانی‌ها و retryها به بودجه باقی‌مانده محدود می‌شوند.
+        """
+        query_cache = self._query_cache
+        if query_cache is None:
+            return self._execute_with_retries(operation, args, kwargs, hedge, deadline)
+        
+        params = self._operation_params(operation, args, kwargs)
+        
+        if operation in self._write_operations:
+            try:
+                return self._execute_with_retries(operation, args, kwargs, hedge, deadline)
+            finally:
+                # نتایج کش شده مرتبط با این collection/document دیگر معتبر نیستند
+                query_cache.invalidate(params.get('collection_id'), params.get('document_id'))
+        
+        if cache is False or operation not in self._cacheable_operations:
+            return self._execute_with_retries(operation, args, kwargs, hedge, deadline)
+        
+        key = QueryCache.make_key(operation, params)
+        cached_result = query_cache.get(key)
+        if cached_result is not QueryCache.MISS:
+            return cached_result
+        
+        generation = query_cache.generation(params.get('collection_id'))
+        result = self._execute_with_retries(operation, args, kwargs, hedge, deadline)
+        query_cache.put(key, result, generation)
+        return result
+    
+    def _execute_with_retries(self, operation, args, kwargs, hedge, deadline=None):
+        """حلقه retry (بدون کش)"""
         last_exception = None
+        use_hedge = self._hedging_enabled if hedge is None else hedge
+        use_hedge = use_hedge and operation in self._hedgeable_operations
         
         for attempt in range(self._retry_attempts):
-            conn_id = None
             try:
-                conn_id, databases = self._get_available_connection()
-                
                 # اجرای عملیات مورد نظر
-                if operation == 'create_document':
-                    result = databases.create_document(*args, **kwargs)
-                elif operation == 'get_document':
-                    result = databases.get_document(*args, **kwargs)
-                elif operation == 'update_document':
-                    result = databases.update_document(*args, **kwargs)
-                elif operation == 'delete_document':
-                    result = databases.delete_document(*args, **kwargs)
-                elif operation == 'list_documents':
-                    result = databases.list_documents(*args, **kwargs)
+                if use_hedge:
+                    result = self._execute_hedged(operation, args, kwargs, deadline)
                 else:
-                    raise ValueError(f"Unknown operation: {operation}")
-                
-                # در صورت موفقیت، خطاهای اتصال را ریست می‌کنیم
-                if conn_id in self._connection_pool:
-                    self._connection_pool[conn_id]['error_count'] = 0
+                    result = self._execute_attempt(operation, args, kwargs, deadline)
                 
+                self._retry_budget.record_success()
                 return result
                 
             except AppwriteException as e:
                 last_exception = e
-                if conn_id:
-                    self._handle_connection_error(conn_id, e)
+                log_event('db.retry', level='warning', operation=operation, attempt=attempt + 1,
+                          code=getattr(e, 'code', None), error=str(e))
                 
-                print(f"Attempt {attempt + 1} failed: {e}")
+                # برای خطاهای دائمی (مثل 404/401/403) retry نمی‌کنیم
+                if not self._is_retryable_error(e) or attempt == self._retry_attempts - 1:
+                    break
+                
+                wait_time = self._get_backoff_time(attempt)
+                
+                # اگر بودجه زمانی برای backoff و تلاش بعدی کافی نیست، retry نمی‌کنیم
+                if deadline is not None and deadline.remaining() <= wait_time:
+                    break
                 
-                # برای برخی خطاها، retry نمی‌کنیم
-                if "404" in str(e) or "401" in str(e) or "403" in str(e):
+                if not self._retry_budget.try_acquire():
+                    log_event('db.retry_budget_exhausted', level='warning', operation=operation)
                     break
                 
-                if attempt < self._retry_attempts - 1:
-                    # Exponential backoff
-                    wait_time = 0.5 * (2 ** attempt)
-                    time.sleep(wait_time)
+                time.sleep(wait_time)
                     
             except Exception as e:
                 last_exception = e
-                if conn_id:
-                    self._handle_connection_error(conn_id, e)
-                print(f"Unexpected error in attempt {attempt + 1}: {e}")
+                log_event('db.operation_failed', level='error', operation=operation,
+                          attempt=attempt + 1, error=str(e))
                 break
-                
-            finally:
-                if conn_id:
-                    self._release_connection(conn_id)
         
         raise last_exception or AppwriteException("All retry attempts failed")
     
-    async def execute_async(self, operation, *args, **kwargs):
+    @staticmethod
+    def _is_retryable_error(error):
+        """طبقه‌بندی خطا بر اساس کد ساختاریافته AppwriteException"""
+        code = getattr(error, 'code', None)
+        if not code:
+            return True  # خطای شبکه یا timeout بدون پاسخ از سرور
+        return code in (408, 429) or code >= 500
+    
+    def _get_backoff_time(self, attempt):
+        """Exponential backoff با full jitter"""
+        return random.uniform(0, min(self._retry_backoff_cap, self._retry_backoff_base * (2 ** attempt)))
+    
+    async def execute_async(self, operation, *args, hedge=None, cache=None, deadline=None, **kwargs):
         """اجرای عملیات به صورت async"""
         loop = asyncio.get_event_loop()
         return await loop.run_in_executor(
             None, 
-            self.execute_with_retry, 
-            operation, 
-            *args, 
-            **kwargs
+            functools.partial(
+                contextvars.copy_context().run,
+                self.execute_with_retry,
+                operation,
+                *args,
+                hedge=hedge,
+                cache=cache,
+                deadline=deadline,
+                **kwargs
+            )
         )
     
+    def execute_many(self, operations, max_parallel=None, deadline=None):
+        """اجرای گروهی عملیات روی pool با موازی‌سازی محدود
+        
+        operations: لیستی از (operation, kwargs). خروجی به همان ترتیب ورودی است و
+        برای هر مورد {'success', 'result', 'error'} برمی‌گرداند؛ خطای یک مورد
+        بقیه را متوقف نمی‌کند.
+        """
+        if not operations:
+            return []
+        
+        max_parallel = min(max_parallel or self._bulk_max_parallel, self._max_connections, len(operations))
+        with ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix='db-bulk') as executor:
+            # هر مورد با یک کپی از context فراخوان اجرا می‌شود تا فیلدهای correlation لاگ حفظ شوند
+            futures = [
+                executor.submit(contextvars.copy_context().run, self._execute_bulk_item, item, deadline)
+                for item in operations
+            ]
+            return [future.result() for future in futures]
+    
+    def _execute_bulk_item(self, item, deadline=None):
+        """اجرای یک مورد از عملیات گروهی با retry مشترک"""
+        operation, kwargs = item
+        try:
+            result = self.execute_with_retry(operation, deadline=deadline, **kwargs)
+            return {'success': True, 'result': result, 'error': None}
+        except Exception as e:
+            return {'success': False, 'result': None, 'error': e}
+    
+    async def execute_many_async(self, operations, max_parallel=None, deadline=None):
+        """اجرای گروهی عملیات به صورت async (ترتیب نتایج حفظ می‌شود)"""
+        if not operations:
+            return []
+        
+        semaphore = asyncio.Semaphore(min(max_parallel or self._bulk_max_parallel, self._max_connections))
+        loop = asyncio.get_event_loop()
+        
+        async def run(item):
+            async with semaphore:
+                return await loop.run_in_executor(
+                    None, contextvars.copy_context().run, self._execute_bulk_item, item, deadline
+                )
+        
+        return await asyncio.gather(*(run(item) for item in operations))
+    
     def health_check(self):
         """بررسی سلامت اتصالات و عملکرد دیتابیس"""
         current_time = time.time()
@@ -211,9 +864,11 @@ class EnhancedDatabaseConnection:
             return True
         
         healthy_connections = 0
-        total_connections = len(self._connection_pool)
+        with self._pool_lock:
+            connections = list(self._connection_pool.items())
+        total_connections = len(connections)
         
-        for conn_id, conn_info in self._connection_pool.items():
+        for conn_id, conn_info in connections:
             try:
                 # تست ساده اتصال با یک query کوچک
                 databases = conn_info['databases']
@@ -228,7 +883,7 @@ class EnhancedDatabaseConnection:
                 conn_info['error_count'] = 0
                 
             except Exception as e:
-                print(f"Health check failed for connection {conn_id}: {e}")
+                log_event('db.health_check.connection_failed', level='warning', conn_id=conn_id, error=str(e))
                 conn_info['error_count'] += 1
                 
                 # اگر خطاها زیاد شد، اتصال را تازه‌سازی می‌کنیم
@@ -238,7 +893,7 @@ class EnhancedDatabaseConnection:
         self._last_health_check = current_time
         health_ratio = healthy_connections / total_connections
         
-        print(f"Health check completed: {healthy_connections}/{total_connections} connections healthy")
+        log_event('db.health_check', healthy=healthy_connections, total=total_connections)
         
         # حداقل 50% اتصالات باید سالم باشند
         return health_ratio >= 0.5
@@ -256,7 +911,10 @@ class EnhancedDatabaseConnection:
         current_time = time.time()
         total_age = 0
         
-        for conn_info in self._connection_pool.values():
+        with self._pool_lock:
+            connections = list(self._connection_pool.values())
+        
+        for conn_info in connections:
             if conn_info['in_use']:
                 stats['active_connections'] += 1
             else:
@@ -270,6 +928,33 @@ class EnhancedDatabaseConnection:
         if stats['total_connections'] > 0:
             stats['average_age'] = total_age / stats['total_connections']
         
+        pool_stats = dict(self._pool_stats)
+        waited = pool_stats['waited_checkouts']
+        stats['pool'] = {
+            'min_connections': self._min_connections,
+            'max_connections': self._max_connections,
+            **pool_stats,
+            'average_wait_time': pool_stats['total_wait_time'] / waited if waited else 0,
+            'recent_wait_time': round(self.get_recent_wait(), 4)
+        }
+        
+        stats['query_cache'] = (
+            {'enabled': True, **self._query_cache.get_stats()}
+            if self._query_cache is not None else {'enabled': False}
+        )
+        
+        stats['retry_budget'] = self._retry_budget.get_stats()
+        
+        stats['hedging'] = {
+            'enabled': self._hedging_enabled,
+            **self._hedge_stats,
+            'budget_tokens': round(self._hedge_budget_tokens, 2),
+            'delays': {
+                operation: round(self._get_hedge_delay(operation), 3)
+                for operation in self._hedgeable_operations
+            }
+        }
+        
         return stats
     
     def cleanup_connections(self):
@@ -286,12 +971,15 @@ class EnhancedDatabaseConnection:
                     cleaned_count += 1
         
         if cleaned_count > 0:
-            print(f"Cleaned up {cleaned_count} old/problematic connections")
+            log_event('db.pool.cleanup', cleaned=cleaned_count)
+        
+        # کوچک کردن pool در صورت بیکاری طولانی
+        cleaned_count += self._evict_idle_connections()
         
         return cleaned_count
 
 # توابع کمکی برای سازگاری با کد قبلی
-def save_conversation(user_id: str, message: str, response: str):
+def save_conversation(user_id: str, message: str, response: str, deadline: Optional[Deadline] = None):
     """ذخیره مکالمه در دیتابیس Appwrite"""
     try:
         db = EnhancedDatabaseConnection()
@@ -305,14 +993,15 @@ def save_conversation(user_id: str, message: str, response: str):
                 'message': message,
                 'response': response,
                 'timestamp': {'$createdAt': True}
-            }
+            },
+            deadline=deadline
         )
         return True
     except Exception as e:
-        print(f"Error saving conversation: {e}")
+        log_event('db.save_conversation_failed', level='error', user_id=user_id, error=str(e))
         return False
 
-async def save_conversation_async(user_id: str, message: str, response: str):
+async def save_conversation_async(user_id: str, message: str, response: str, deadline: Optional[Deadline] = None):
     """ذخیره مکالمه به صورت async"""
     try:
         db = EnhancedDatabaseConnection()
@@ -326,40 +1015,67 @@ async def save_conversation_async(user_id: str, message: str, response: str):
                 'message': message,
                 'response': response,
                 'timestamp': {'$createdAt': True}
-            }
+            },
+            deadline=deadline
         )
         return True
     except Exception as e:
-        print(f"Error saving conversation async: {e}")
+        log_event('db.save_conversation_failed', level='error', user_id=user_id, error=str(e))
         return False
 
-def get_user_history(chat_id: str, limit: int = 5):
-    """دریافت تاریخچه مکالمات کاربر"""
+def summary_document_id(chat_id: str) -> str:
+    """شناسه ثابت سند خلاصه هر chat (حداکثر 36 کاراکتر مجاز Appwrite)"""
+    return "sum_" + hashlib.sha1(str(chat_id).encode('utf-8')).hexdigest()[:32]
+
+def get_conversation_summary(chat_id: str, cache: Optional[bool] = None,
+                             deadline: Optional[Deadline] = None) -> Optional[Dict[str, Any]]:
+    """دریافت سند خلاصه مکالمات chat (در صورت نبود None)"""
+    db = EnhancedDatabaseConnection()
+    try:
+        return db.execute_with_retry(
+            'get_document',
+            database_id=APPWRITE_DATABASE_ID,
+            collection_id=APPWRITE_SUMMARIES_COLLECTION_ID,
+            document_id=summary_document_id(chat_id),
+            cache=cache,
+            deadline=deadline
+        )
+    except AppwriteException as e:
+        if e.code == 404:
+            return None
+        raise
+
+def get_user_history(chat_id: str, limit: int = 5, deadline: Optional[Deadline] = None):
+    """دریافت تاریخچه مکالمات کاربر (خلاصه نوبت‌های قدیمی + چند نوبت اخیر)"""
     try:
         db = EnhancedDatabaseConnection()
+        summary = get_conversation_summary(chat_id, deadline=deadline)
         result = db.execute_with_retry(
             'list_documents',
             database_id=APPWRITE_DATABASE_ID,
             collection_id=APPWRITE_COLLECTION_ID,
-            queries=[f"user_id={chat_id}", "orderDesc('timestamp')", f"limit({limit})"]
+            queries=[f"user_id={chat_id}", "orderDesc('timestamp')", f"limit({limit})"],
+            deadline=deadline
         )
         
         conversations = result.get('documents', [])
         
-        if not conversations:
+        if not conversations and not summary:
             return "تاریخچه‌ای یافت نشد."
         
         history = "\n\n".join([
             f"پیام: {conv['message']}\nپاسخ: {conv['response']}" 
             for conv in conversations
         ])
+        if summary:
+            history = f"خلاصه مکالمات قبلی:\n{summary['summary']}\n\n{history}".rstrip()
         return history
         
     except Exception as e:
-        print(f"Error getting user history: {e}")
+        log_event('db.get_history_failed', level='error', chat_id=chat_id, error=str(e))
         return f"خطا در دریافت تاریخچه: {str(e)}"
 
-def delete_user_history(chat_id: str):
+def delete_user_history(chat_id: str, deadline: Optional[Deadline] = None):
     """حذف تاریخچه مکالمات کاربر"""
     try:
         db = EnhancedDatabaseConnection()
@@ -369,42 +1085,208 @@ def delete_user_history(chat_id: str):
             'list_documents',
             database_id=APPWRITE_DATABASE_ID,
             collection_id=APPWRITE_COLLECTION_ID,
-            queries=[f"user_id={chat_id}", "limit(100)"]
+            queries=[f"user_id={chat_id}", "limit(100)"],
+            cache=False,
+            deadline=deadline
         )
         
         conversations = result.get('documents', [])
+        summary_deleted = _delete_conversation_summary(db, chat_id, deadline)
         
-        if not conversations:
+        if not conversations and not summary_deleted:
             return "تاریخچه‌ای برای حذف یافت نشد."
         
-        # حذف تک تک مکالمات
+        # حذف گروهی مکالمات
+        results = db.execute_many([
+            ('delete_document', {
+                'database_id': APPWRITE_DATABASE_ID,
+                'collection_id': APPWRITE_COLLECTION_ID,
+                'document_id': conv['$id']
+            })
+            for conv in conversations
+        ], deadline=deadline)
+        
         deleted_count = 0
-        for conv in conversations:
-            try:
-                db.execute_with_retry(
-                    'delete_document',
-                    database_id=APPWRITE_DATABASE_ID,
-                    collection_id=APPWRITE_COLLECTION_ID,
-                    document_id=conv['$id']
-                )
+        for conv, item in zip(conversations, results):
+            if item['success']:
                 deleted_count += 1
-            except Exception as e:
-                print(f"Error deleting conversation {conv['$id']}: {e}")
+            else:
+                log_event('db.delete_conversation_failed', level='error',
+                          document_id=conv['$id'], error=str(item['error']))
         
         return f"تاریخچه مکالمات حذف شد. {deleted_count} مکالمه حذف شد."
         
     except Exception as e:
-        print(f"Error deleting user history: {e}")
+        log_event('db.delete_history_failed', level='error', chat_id=chat_id, error=str(e))
         return f"خطا در حذف تاریخچه: {str(e)}"
 
+def _delete_conversation_summary(db, chat_id: str, deadline: Optional[Deadline] = None) -> bool:
+    """حذف سند خلاصه chat؛ True اگر سندی حذف شد"""
+    try:
+        db.execute_with_retry(
+            'delete_document',
+            database_id=APPWRITE_DATABASE_ID,
+            collection_id=APPWRITE_SUMMARIES_COLLECTION_ID,
+            document_id=summary_document_id(chat_id),
+            deadline=deadline
+        )
+        return True
+    except AppwriteException as e:
+        if e.code != 404:
+            log_event('db.delete_summary_failed', level='error', chat_id=chat_id, error=str(e))
+        return False
+
+async def compact_user_history(chat_id: str, summarize, keep_recent: int = COMPACTION_KEEP_RECENT,
+                               batch_size: int = COMPACTION_BATCH_SIZE,
+                               deadline: Optional[Deadline] = None) -> int:
+    """تجمیع نوبت‌های قدیمی یک chat در سند خلاصه و حذف آن‌ها
+    
+    summarize یک تابع async با امضای (chat_id, previous_summary, turns, deadline=) است که خلاصه
+    جدید را برمی‌گرداند. در هر اجرا قدیمی‌ترین نوبت‌ها (به جز keep_recent نوبت اخیر)
+    به ترتیب خلاصه می‌شوند. ابتدا خلاصه ذخیره و سپس فقط نوبت‌هایی که در خلاصه آمده‌اند
+    (تا folded_until) حذف می‌شوند؛ folded_until همچنین تضمین می‌کند نوبتی که حذفش
+    ناموفق بوده در اجرای بعدی دوباره خلاصه نشود. تعداد نوبت‌های حذف شده را برمی‌گرداند.
+    """
+    db = EnhancedDatabaseConnection()
+    recent, oldest = await asyncio.gather(
+        db.execute_async(
+            'list_documents',
+            database_id=APPWRITE_DATABASE_ID,
+            collection_id=APPWRITE_COLLECTION_ID,
+            queries=[f"user_id={chat_id}", "orderDesc('timestamp')", f"limit({keep_recent})"],
+            cache=False,
+            deadline=deadline
+        ),
+        db.execute_async(
+            'list_documents',
+            database_id=APPWRITE_DATABASE_ID,
+            collection_id=APPWRITE_COLLECTION_ID,
+            queries=[f"user_id={chat_id}", "orderAsc('timestamp')", f"limit({batch_size})"],
+            cache=False,
+            deadline=deadline
+        )
+    )
+    
+    # قدیمی‌ترین نوبت‌ها به جز نوبت‌های اخیر که به صورت خام باقی می‌مانند
+    recent_documents = recent.get('documents', [])
+    if len(recent_documents) < keep_recent:
+        return 0
+    recent_ids = {turn['$id'] for turn in recent_documents}
+    older_turns = [turn for turn in oldest.get('documents', []) if turn['$id'] not in recent_ids]
+    if not older_turns:
+        return 0
+    
+    summary = await asyncio.get_event_loop().run_in_executor(
+        None, functools.partial(get_conversation_summary, chat_id, cache=False, deadline=deadline)
+    )
+    folded_until = summary.get('folded_until', '') if summary else ''
+    new_turns = [turn for turn in older_turns if turn.get('$createdAt', '') > folded_until]
+    
+    if new_turns:
+        previous_summary = summary['summary'] if summary else ''
+        new_summary = (await summarize(chat_id, previous_summary, new_turns, deadline=deadline))[:SUMMARY_MAX_CHARS]
+        data = {
+            'user_id': chat_id,
+            'summary': new_summary,
+            'turns_folded': (summary.get('turns_folded', 0) if summary else 0) + len(new_turns),
+            'folded_until': max(turn.get('$createdAt', '') for turn in new_turns),
+            'updated_at': time.time()
+        }
+        await db.execute_async(
+            'update_document' if summary else 'create_document',
+            database_id=APPWRITE_DATABASE_ID,
+            collection_id=APPWRITE_SUMMARIES_COLLECTION_ID,
+            document_id=summary_document_id(chat_id),
+            data=data,
+            deadline=deadline
+        )
+        folded_until = data['folded_until']
+    
+    # نوبتی که هیچ‌وقت در خلاصه نیامده حذف نمی‌شود
+    folded_turns = [turn for turn in older_turns if turn.get('$createdAt', '') <= folded_until]
+    if not folded_turns:
+        return 0
+    
+    results = await db.execute_many_async([
+        ('delete_document', {
+            'database_id': APPWRITE_DATABASE_ID,
+            'collection_id': APPWRITE_COLLECTION_ID,
+            'document_id': turn['$id']
+        })
+        for turn in folded_turns
+    ], deadline=deadline)
+    
+    deleted_count = sum(1 for item in results if item['success'])
+    log_event('db.history_compacted', chat_id=chat_id, summarized=len(new_turns), deleted=deleted_count)
+    return deleted_count
+
+async def compact_conversation_history(summarize, max_chats: int = COMPACTION_MAX_CHATS,
+                                       deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+    """یک دور فشرده‌سازی: یافتن chatهای دارای نوبت‌های قدیمی و خلاصه کردن آن‌ها
+    
+    اسناد مکالمه از قدیمی‌ترین به جدیدترین صفحه به صفحه پیمایش می‌شوند تا طولانی‌ترین
+    تاریخچه‌ها زودتر فشرده شوند. نوبت‌های نگه داشته شده chatهای کوتاه یا قبلاً فشرده
+    شده همیشه قدیمی‌ترین اسناد می‌مانند، پس پیمایش از آن‌ها عبور می‌کند و در نمونه گرم
+    اجرای بعدی از همان نقطه ادامه می‌یابد. با نزدیک شدن به پایان deadline اجرا متوقف می‌شود.
+    """
+    global _compaction_scan_offset
+    
+    db = EnhancedDatabaseConnection()
+    seen_chats = set()
+    stats = {'scanned_docs': 0, 'scanned_chats': 0, 'compacted_chats': 0, 'deleted_turns': 0, 'failed_chats': 0}
+    
+    for _ in range(COMPACTION_MAX_SCAN_PAGES):
+        if stats['compacted_chats'] >= max_chats or (deadline and deadline.expired()):
+            break
+        
+        result = await db.execute_async(
+            'list_documents',
+            database_id=APPWRITE_DATABASE_ID,
+            collection_id=APPWRITE_COLLECTION_ID,
+            queries=["orderAsc('timestamp')", f"limit({COMPACTION_SCAN_LIMIT})", f"offset({_compaction_scan_offset})"],
+            cache=False,
+            deadline=deadline
+        )
+        documents = result.get('documents', [])
+        stats['scanned_docs'] += len(documents)
+        
+        deleted_in_page = 0
+        for chat_id in OrderedDict.fromkeys(doc['user_id'] for doc in documents):
+            if stats['compacted_chats'] >= max_chats or (deadline and deadline.expired()):
+                break
+            if chat_id in seen_chats:
+                continue
+            seen_chats.add(chat_id)
+            stats['scanned_chats'] += 1
+            try:
+                deleted_count = await compact_user_history(chat_id, summarize, deadline=deadline)
+            except Exception as e:
+                stats['failed_chats'] += 1
+                log_event('db.compaction_failed', level='error', chat_id=chat_id, error=str(e))
+                continue
+            if deleted_count:
+                stats['compacted_chats'] += 1
+                stats['deleted_turns'] += deleted_count
+                deleted_in_page += deleted_count
+        
+        if stats['compacted_chats'] >= max_chats or (deadline and deadline.expired()):
+            break  # همین صفحه در اجرای بعدی دوباره پیمایش می‌شود
+        if len(documents) < COMPACTION_SCAN_LIMIT:
+            _compaction_scan_offset = 0  # انتهای collection؛ دور بعد از ابتدا شروع می‌شود
+            break
+        # اسناد حذف شده جای اسناد بعدی را جابه‌جا می‌کنند؛ offset محافظه‌کارانه عقب می‌رود
+        # (chatهای تکراری با seen_chats رد می‌شوند)
+        _compaction_scan_offset = max(0, _compaction_scan_offset + len(documents) - deleted_in_page)
+    
+    stats['scan_offset'] = _compaction_scan_offset
+    return stats
+
+_compaction_scan_offset = 0  # نقطه ادامه پیمایش compaction در این نمونه
+
 # تابع ساده برای اتصال به دیتابیس (برای سازگاری با کد قبلی)
 def init_appwrite():
-    """راه‌اندازی کلاینت Appwrite"""
-    client = Client()
-    client.set_endpoint(APPWRITE_ENDPOINT)
-    client.set_project(APPWRITE_PROJECT_ID)
-    client.set_key(APPWRITE_API_KEY)
-    return client
+    """راه‌اندازی کلاینت Appwrite (روی HTTP session مشترک)"""
+    return EnhancedDatabaseConnection._create_client()
 
 # کلاس اصلی برای export (سازگاری با کد قبلی)
 DatabaseConnection = EnhancedDatabaseConnection
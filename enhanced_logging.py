@@ -0,0 +1,117 @@
+import sys
+import json
+import time
+import queue
+import random
+import threading
+import contextvars
+from typing import Any, Dict
+
+# نرخ نمونه‌برداری رویدادهای پرتکرار (1.0 یعنی همه رکوردها ثبت می‌شوند)
+# رکوردهای سطح error هیچ‌وقت نمونه‌برداری نمی‌شوند
+LOG_SAMPLE_RATES = {
+    'db.retry': 0.1,
+    'db.pool.refresh': 0.05,
+    'db.pool.grow': 0.2,
+    'webhook.processed': 0.2,
+    'webhook.shed': 0.1
+}
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 100
+
+_log_context = contextvars.ContextVar('log_context', default={})
+_log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_writer_thread = None
+_writer_lock = threading.Lock()
+_log_stats = {'enqueued': 0, 'sampled_out': 0, 'dropped': 0, 'written': 0}
+
+
+def bind_log_context(**fields) -> contextvars.Token:
+    """افزودن فیلدهای correlation (مثل chat_id و update_id) به تمام رکوردهای این context"""
+    return _log_context.set({**_log_context.get(), **fields})
+
+
+def reset_log_context(token: contextvars.Token):
+    """بازگرداندن context لاگ به حالت قبل از bind_log_context"""
+    _log_context.reset(token)
+
+
+def log_event(event: str, level: str = 'info', **fields):
+    """ثبت یک رویداد ساختاریافته بدون مسدود کردن مسیر اصلی
+
+    رکورد فقط در صف قرار می‌گیرد و نوشتن روی stdout در thread جداگانه انجام می‌شود.
+    اگر صف پر باشد رکورد دور ریخته می‌شود تا پردازش درخواست کند نشود.
+    """
+    sample_rate = LOG_SAMPLE_RATES.get(event, 1.0)
+    if level != 'error' and sample_rate < 1.0 and random.random() >= sample_rate:
+        _log_stats['sampled_out'] += 1
+        return
+
+    record = {
+        'ts': round(time.time(), 3),
+        'level': level,
+        'event': event,
+        **_log_context.get(),
+        **fields
+    }
+    if sample_rate < 1.0:
+        record['sample_rate'] = sample_rate
+
+    _ensure_writer()
+    try:
+        _log_queue.put_nowait(record)
+        _log_stats['enqueued'] += 1
+    except queue.Full:
+        _log_stats['dropped'] += 1
+
+
+def _ensure_writer():
+    """راه‌اندازی thread نویسنده در اولین استفاده"""
+    global _writer_thread
+    if _writer_thread is not None:
+        return
+
+    with _writer_lock:
+        if _writer_thread is None:
+            thread = threading.Thread(target=_writer_loop, name='log-writer', daemon=True)
+            thread.start()
+            _writer_thread = thread
+
+
+def _writer_loop():
+    """نوشتن دسته‌ای رکوردها به صورت JSON lines روی stdout"""
+    while True:
+        records = [_log_queue.get()]
+        while len(records) < LOG_BATCH_SIZE:
+            try:
+                records.append(_log_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            lines = [json.dumps(record, ensure_ascii=False, default=str) for record in records]
+            sys.stdout.write("\n".join(lines) + "\n")
+            sys.stdout.flush()
+            _log_stats['written'] += len(records)
+        except Exception:
+            pass  # خطای نوشتن لاگ نباید thread نویسنده را متوقف کند
+        finally:
+            for _ in records:
+                _log_queue.task_done()
+
+
+def flush_logs(timeout: float = 1.0) -> bool:
+    """انتظار برای نوشته شدن رکوردهای صف (در پایان هر invocation صدا زده می‌شود)"""
+    deadline = time.monotonic() + timeout
+    with _log_queue.all_tasks_done:
+        while _log_queue.unfinished_tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            _log_queue.all_tasks_done.wait(remaining)
+    return True
+
+
+def get_log_stats() -> Dict[str, Any]:
+    """آمار لاگ برای monitoring"""
+    return {**_log_stats, 'queue_size': _log_queue.qsize()}
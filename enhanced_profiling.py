@@ -0,0 +1,191 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+import tracemalloc
+from collections import Counter
+from typing import Any, Dict, List
+
+# تنظیمات پروفایل‌گیری روی نمونه گرم
+PROFILE_MAX_DURATION = 10  # حداکثر مدت هر پروفایل (ثانیه)
+PROFILE_SAMPLE_INTERVAL = 0.005  # فاصله نمونه‌برداری CPU (ثانیه)
+PROFILE_TRACEMALLOC_FRAMES = 10
+PROFILE_IGNORED_THREADS = ('log-writer',)
+
+_active_loops = {}  # id(loop) -> (loop, نام thread)
+_loops_lock = threading.Lock()
+_profile_lock = threading.Lock()  # در هر لحظه فقط یک پروفایل اجرا می‌شود
+
+
+async def track_event_loop(coro):
+    """اجرای coroutine با ثبت event loop آن برای dump تسک‌ها از thread دیگر"""
+    loop = asyncio.get_running_loop()
+    with _loops_lock:
+        _active_loops[id(loop)] = (loop, threading.current_thread().name)
+    try:
+        return await coro
+    finally:
+        with _loops_lock:
+            _active_loops.pop(id(loop), None)
+
+
+def _frame_label(code) -> str:
+    filename = os.sep.join(code.co_filename.split(os.sep)[-2:])
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def _is_thread_bootstrap(code) -> bool:
+    """فریم‌های راه‌اندازی thread که در همه پشته‌ها تکرار می‌شوند"""
+    return code.co_filename == threading.__file__ and code.co_name in ('_bootstrap', '_bootstrap_inner', 'run')
+
+
+def _is_idle_stack(stack) -> bool:
+    """thread بیکار executor (منتظر کار جدید در _worker)"""
+    leaf = stack[-1]
+    return leaf.co_name == '_worker' and leaf.co_filename.endswith(os.path.join('concurrent', 'futures', 'thread.py'))
+
+
+def sample_cpu(duration: float, interval: float = PROFILE_SAMPLE_INTERVAL, top: int = 20) -> Dict[str, Any]:
+    """پروفایل نمونه‌برداری (wall-clock) از تمام threadها با sys._current_frames
+
+    برای هر تابع تعداد نمونه‌هایی که در پشته بوده (cumulative) و نمونه‌هایی که
+    خودش در بالای پشته بوده (self) شمرده می‌شود؛ انتظار روی lock/Condition هم
+    به عنوان زمان تابع منتظر دیده می‌شود که برای یافتن رقابت روی pool لازم است.
+    """
+    own_thread = threading.get_ident()
+    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+    cumulative = Counter()
+    self_samples = Counter()
+    samples = 0
+    idle_samples = 0
+
+    end_time = time.monotonic() + duration
+    while time.monotonic() < end_time:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            if thread_id not in thread_names:
+                thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            if thread_names.get(thread_id) in PROFILE_IGNORED_THREADS:
+                continue
+
+            stack = []
+            while frame is not None:
+                if not _is_thread_bootstrap(frame.f_code):
+                    stack.append(frame.f_code)
+                frame = frame.f_back
+            stack.reverse()
+            if not stack:
+                continue
+            if _is_idle_stack(stack):
+                idle_samples += 1
+                continue
+
+            samples += 1
+            self_samples[_frame_label(stack[-1])] += 1
+            for label in {_frame_label(code) for code in stack}:
+                cumulative[label] += 1
+        time.sleep(interval)
+
+    def ranked(counter):
+        return [
+            {'function': label, 'samples': count, 'percent': round(100.0 * count / samples, 1)}
+            for label, count in counter.most_common(top)
+        ]
+
+    return {
+        'duration': round(duration, 3),
+        'samples': samples,
+        'idle_samples': idle_samples,
+        'top_cumulative': ranked(cumulative),
+        'top_self': ranked(self_samples)
+    }
+
+
+def dump_asyncio_tasks(stack_limit: int = 8) -> List[Dict[str, Any]]:
+    """فهرست تسک‌های asyncio تمام event loopهای فعال به همراه پشته هر تسک"""
+    with _loops_lock:
+        loops = list(_active_loops.values())
+
+    report = []
+    for loop, thread_name in loops:
+        tasks = []
+        try:
+            loop_tasks = asyncio.all_tasks(loop)
+        except RuntimeError:
+            continue  # loop در همین لحظه در حال تغییر بود
+        for task in loop_tasks:
+            coro = task.get_coro()
+            tasks.append({
+                'name': task.get_name(),
+                'coro': getattr(coro, '__qualname__', repr(coro)),
+                'done': task.done(),
+                'stack': _coroutine_stack(coro, stack_limit)
+            })
+        report.append({'thread': thread_name, 'task_count': len(tasks), 'tasks': tasks})
+    return report
+
+
+def _coroutine_stack(coro, limit: int) -> List[str]:
+    """دنبال کردن زنجیره await یک coroutine تا عمیق‌ترین نقطه انتظار"""
+    stack = []
+    while coro is not None and len(stack) < limit:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            if not hasattr(coro, 'cr_frame') and not hasattr(coro, 'gi_frame'):
+                stack.append(f"awaiting {type(coro).__name__}")
+            break
+        stack.append(f"{_frame_label(frame.f_code)} line {frame.f_lineno}")
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return stack
+
+
+def tracemalloc_diff(duration: float, top: int = 20) -> Dict[str, Any]:
+    """مقایسه دو snapshot از tracemalloc با فاصله duration و گزارش بیشترین تخصیص‌دهنده‌ها"""
+    started_here = not tracemalloc.is_tracing()
+    if started_here:
+        tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+
+    try:
+        before = tracemalloc.take_snapshot()
+        time.sleep(duration)
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started_here:
+            tracemalloc.stop()  # tracing سربار دارد و فقط در طول پروفایل فعال می‌ماند
+
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')
+    return {
+        'duration': round(duration, 3),
+        'traced_current_kb': round(current / 1024, 1),
+        'traced_peak_kb': round(peak / 1024, 1),
+        'top_allocators': [
+            {
+                'location': f"{os.sep.join(stat.traceback[0].filename.split(os.sep)[-2:])}:{stat.traceback[0].lineno}",
+                'size_diff_kb': round(stat.size_diff / 1024, 1),
+                'count_diff': stat.count_diff,
+                'size_kb': round(stat.size / 1024, 1)
+            }
+            for stat in stats[:top]
+        ]
+    }
+
+
+def run_profile(mode: str, duration: float, top: int = 20) -> Dict[str, Any]:
+    """اجرای یک پروفایل محدود به زمان (cpu، tasks یا memory)"""
+    duration = max(0.0, min(duration, PROFILE_MAX_DURATION))
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError("پروفایل دیگری در حال اجرا است")
+    try:
+        if mode == 'cpu':
+            return {'mode': mode, **sample_cpu(duration, top=top)}
+        if mode == 'tasks':
+            return {'mode': mode, 'loops': dump_asyncio_tasks()}
+        if mode == 'memory':
+            return {'mode': mode, **tracemalloc_diff(duration, top=top)}
+        raise ValueError(f"نوع پروفایل نامعتبر: {mode}")
+    finally:
+        _profile_lock.release()
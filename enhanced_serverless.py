@@ -1,29 +1,82 @@
+import ast
 import json
 import os
+import re
+import hmac
+import hashlib
+import zlib
 import asyncio
+import functools
+import random
+import threading
 import time
+import uuid
+from collections import OrderedDict, deque
 from typing import Dict, Any, Optional
 import requests
-import langdetect
-from appwrite.client import Client
-from appwrite.services.databases import Databases
-from appwrite.services.functions import Functions
+from enhanced_logging import log_event, bind_log_context, reset_log_context, flush_logs, get_log_stats
+from enhanced_database import (
+    APPWRITE_DATABASE_ID,
+    APPWRITE_COLLECTION_ID,
+    SUMMARY_MAX_CHARS,
+    Deadline,
+    DeadlineExceeded,
+    EnhancedDatabaseConnection,
+    compact_conversation_history,
+    save_conversation_async
+)
+from enhanced_profiling import track_event_loop, run_profile
+from enhanced_workers import CpuWorkerPool, CPU_POOL_WORKERS, SHARED_MEMORY_MIN_BYTES
 from appwrite.exception import AppwriteException
 
-# تنظیمات Appwrite
-APPWRITE_ENDPOINT = ""
-APPWRITE_PROJECT_ID = ""
-APPWRITE_API_KEY = ""
-APPWRITE_DATABASE_ID = ""
-APPWRITE_COLLECTION_ID = ""
+# تنظیمات Appwrite (اتصال و collection مکالمات در enhanced_database تعریف شده‌اند)
 APPWRITE_MESSAGES_COLLECTION_ID = ""
 APPWRITE_FAILED_MESSAGES_COLLECTION_ID = ""
+APPWRITE_RECOVERY_LEASES_COLLECTION_ID = ""
+
+# بازیابی موازی پیام‌های ناموفق توسط چند نمونه
+RECOVERY_SHARDS = 4  # پیام‌ها بر اساس chat_id بین shardها پخش می‌شوند
+RECOVERY_BATCH_SIZE = 10  # حداکثر پیام‌های پردازش شده در هر اجرای recovery
+RECOVERY_LEASE_TTL = 30  # مدت اعتبار lease هر پیام (ثانیه)
+RECOVERY_LEASE_CLOCK_SKEW = 2  # حاشیه اطمینان برای اختلاف ساعت بین نمونه‌ها
+
+# spool محلی پیام‌های ناموفق برای زمانی که Appwrite در دسترس نیست
+FAILED_MESSAGES_SPOOL_PATH = "/tmp/pytech_failed_messages.jsonl"
 
 # تنظیمات Telegram و Gemini
 TELEGRAM_TOKEN = ""
+TELEGRAM_MESSAGE_LIMIT = 4096
+TELEGRAM_CAPTION_LIMIT = 1024
+TELEGRAM_MEDIA_GROUP_LIMIT = 10  # حداکثر فایل در هر sendMediaGroup
+CODE_FILE_MIN_LINES = 5  # بلوک‌های کد Python کوتاه‌تر به صورت متن باقی می‌مانند
 GEMINI_API_KEY = ""
 GEMINI_API_URL = ""
 
+# زمان‌بندی عادلانه درخواست‌های Gemini بین کاربران
+GEMINI_MAX_CONCURRENCY = 4  # حداکثر درخواست هم‌زمان به Gemini
+GEMINI_INTERACTIVE_MAX_CHARS = 2000  # promptهای کوتاه‌تر در lane تعاملی (با اولویت) قرار می‌گیرند
+GEMINI_SCHEDULER_QUANTUM = 2000  # سهم هر chat در هر دور (بر حسب کاراکتر prompt)
+GEMINI_BULK_SHARE = 4  # پس از هر چند نوبت lane تعاملی یک نوبت به lane bulk داده می‌شود
+GEMINI_MIN_CALL_BUDGET = 5  # حداقل زمان باقی‌مانده برای خود فراخوانی Gemini پس از انتظار در صف (ثانیه)
+
+# cache پیشوند ثابت (SYSTEM_PROMPT) در Gemini برای هر زبان
+GEMINI_CONTEXT_CACHE_TTL = 3600  # مدت اعتبار cachedContent (ثانیه)
+GEMINI_CONTEXT_CACHE_REFRESH_MARGIN = 300  # تمدید cache این مقدار پیش از انقضا
+GEMINI_CONTEXT_CACHE_RETRY_INTERVAL = 600  # فاصله تلاش دوباره پس از خطا در ساخت/تمدید cache
+
+# آستانه‌های کنترل پذیرش webhook (بالاتر از آن‌ها بار اضافه رها می‌شود)
+ADMISSION_MAX_IN_FLIGHT = 8  # حداکثر webhook هم‌زمان در این نمونه
+ADMISSION_MAX_POOL_WAIT = 1.0  # میانگین اخیر انتظار برای اتصال pool (ثانیه)
+ADMISSION_MAX_UPSTREAM_LATENCY = 8.0  # میانگین اخیر latency پاسخ Gemini (ثانیه)
+ADMISSION_SIGNAL_HALF_LIFE = 10  # کاهش میانگین‌ها با گذشت زمان تا پذیرش دوباره از سر گرفته شود
+
+# توکن دسترسی به GET /debug/profile (خالی یعنی endpoint غیرفعال است)
+DEBUG_PROFILE_TOKEN = ""
+
+# بودجه زمانی هر درخواست (باید کمتر از محدودیت زمان اجرای فانکشن Appwrite باشد)
+REQUEST_DEADLINE = 14
+FAILURE_PATH_RESERVE = 2  # ثانیه‌های رزرو شده برای ذخیره پیام ناموفق
+
 # پرامپت سیستمی
 SYSTEM_PROMPT = """سلام! من PyTech هستم، یک دستیار برنامه‌نویسی هوشمند که توسط تیم HiTech ساخته شده‌ام. وظایف من عبارتند از:
 - کمک به نوشتن کد تمیز، کارآمد و مستندسازی شده
@@ -40,179 +93,720 @@ You must ONLY respond in the same language as the user's message:
 Send code files as .py files to users.
 Only introduce yourself as PyTech when specifically asked about your name or identity."""
 
-# کلاس مدیریت اتصال بهبود یافته
-class EnhancedDatabaseConnection:
-    """کلاس مدیریت اتصال بهبود یافته با قابلیت‌های real-time"""
-    
-    _instance = None
-    _connection_pool = {}
-    _max_connections = 10
-    _connection_timeout = 30
-    _retry_attempts = 3
-    _last_health_check = 0
-    _health_check_interval = 300  # 5 دقیقه
-    
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(EnhancedDatabaseConnection, cls).__new__(cls)
-            cls._instance._initialize()
-        return cls._instance
-    
-    def _initialize(self):
-        """راه‌اندازی اولیه"""
-        self._create_connection_pool()
-    
-    def _create_connection_pool(self):
-        """ایجاد pool اتصالات"""
-        try:
-            for i in range(self._max_connections):
-                client = Client()
-                client.set_endpoint(APPWRITE_ENDPOINT)
-                client.set_project(APPWRITE_PROJECT_ID)
-                client.set_key(APPWRITE_API_KEY)
-                
-                self._connection_pool[f"conn_{i}"] = {
-                    'client': client,
-                    'databases': Databases(client),
-                    'in_use': False,
-                    'created_at': time.time(),
-                    'last_used': time.time()
-                }
-            print(f"Connection pool ایجاد شد با {self._max_connections} اتصال")
-        except Exception as e:
-            print(f"خطا در ایجاد connection pool: {e}")
-            raise
+# دستور خلاصه‌سازی نوبت‌های قدیمی مکالمه در فشرده‌سازی تاریخچه
+COMPACTION_PROMPT = """Update the running summary of a conversation between a user and PyTech, a programming assistant.
+Keep the user's goals, the code and technologies discussed, decisions made and open questions.
+Write in the language the user mostly used and keep it under {max_chars} characters.
+
+Current summary:
+{summary}
+
+New turns:
+{transcript}"""
+
+class FailedMessageSpool:
+    """spool محلی append-only برای پیام‌های ناموفق (فرمت JSONL)
     
-    def _get_available_connection(self):
-        """دریافت اتصال آزاد از pool"""
-        current_time = time.time()
+    نوشتن فوری است و fsync به صورت دسته‌ای انجام می‌شود (هر fsync_batch رکورد یا
+    هر fsync_interval ثانیه)؛ flush() در پایان هر invocation باقی‌مانده را fsync می‌کند.
+    رکوردهای پردازش شده با بازنویسی اتمیک فایل (os.replace) حذف می‌شوند.
+    """
+    
+    def __init__(self, path, fsync_batch=8, fsync_interval=0.5):
+        self.path = path
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self._file = None
+        self._pending_sync = 0
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def append(self, record: Dict[str, Any]) -> str:
+        """افزودن رکورد به انتهای spool و برگرداندن شناسه آن"""
+        record = {'spool_id': uuid.uuid4().hex, 'spooled_at': time.time(), **record}
+        line = json.dumps(record, ensure_ascii=False)
         
-        # جستجو برای اتصال آزاد
-        for conn_id, conn_info in self._connection_pool.items():
-            if not conn_info['in_use']:
-                # بررسی timeout اتصال
-                if current_time - conn_info['last_used'] > self._connection_timeout:
-                    self._refresh_connection(conn_id)
-                
-                conn_info['in_use'] = True
-                conn_info['last_used'] = current_time
-                return conn_id, conn_info['databases']
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(line + "\n")
+            self._file.flush()
+            self._pending_sync += 1
+            
+            if (self._pending_sync >= self.fsync_batch or
+                    time.monotonic() - self._last_sync >= self.fsync_interval):
+                self._sync()
         
-        # اگر اتصال آزاد نبود، منتظر می‌مانیم
-        return self._wait_for_connection()
+        return record['spool_id']
     
-    def _refresh_connection(self, conn_id):
-        """تازه‌سازی اتصال منقضی شده"""
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._pending_sync = 0
+        self._last_sync = time.monotonic()
+    
+    def flush(self):
+        """fsync رکوردهای نوشته شده‌ای که هنوز روی دیسک ثبت نشده‌اند"""
+        with self._lock:
+            if self._file is not None and self._pending_sync:
+                self._sync()
+    
+    def read_all(self) -> list:
+        """خواندن تمام رکوردهای spool (خط ناقص انتهای فایل نادیده گرفته می‌شود)"""
+        with self._lock:
+            return self._read_records()
+    
+    def _read_records(self):
+        if not os.path.exists(self.path):
+            return []
+        
+        records = []
+        with open(self.path, 'r', encoding='utf-8') as spool_file:
+            for line in spool_file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue  # رکورد نیمه‌کاره پس از crash
+        return records
+    
+    def remove(self, spool_ids):
+        """حذف رکوردهای پردازش شده"""
+        spool_ids = set(spool_ids)
+        if spool_ids:
+            self._rewrite(lambda record: None if record['spool_id'] in spool_ids else record)
+    
+    def update(self, updates: Dict[str, Dict[str, Any]]):
+        """به‌روزرسانی فیلدهای رکوردها (مثل retry_count) بر اساس spool_id"""
+        if updates:
+            self._rewrite(lambda record: {**record, **updates.get(record['spool_id'], {})})
+    
+    def _rewrite(self, transform):
+        """بازنویسی اتمیک فایل spool با اعمال transform روی هر رکورد"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                self._pending_sync = 0
+            
+            records = [transform(record) for record in self._read_records()]
+            temp_path = self.path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as temp_file:
+                for record in records:
+                    if record is not None:
+                        temp_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            os.replace(temp_path, self.path)
+    
+    def count(self) -> int:
+        return len(self.read_all())
+
+class GeminiScheduler:
+    """زمان‌بند عادلانه وزن‌دار برای درخواست‌های Gemini
+    
+    هر lane (تعاملی و bulk) برای هر chat یک صف جداگانه دارد و نوبت بین chatها با
+    Deficit Round Robin داده می‌شود؛ هزینه هر درخواست طول prompt آن است، پس کاربری که
+    پشت سر هم فایل‌های بزرگ می‌فرستد بیش از سهم خود از ظرفیت را نمی‌گیرد.
+    lane تعاملی اولویت دارد ولی lane bulk هر bulk_share نوبت یک‌بار سرویس می‌گیرد.
+    صف‌ها thread-safe هستند و منتظرها با call_soon_threadsafe در loop خودشان بیدار می‌شوند.
+    """
+    
+    LANES = ('interactive', 'bulk')
+    
+    def __init__(self, max_concurrency=4, quantum=2000, interactive_max_cost=2000, bulk_share=4):
+        self.max_concurrency = max_concurrency
+        self.quantum = quantum
+        self.interactive_max_cost = interactive_max_cost
+        self.bulk_share = bulk_share
+        self._lock = threading.Lock()
+        self._active = 0
+        self._interactive_streak = 0
+        self._queues = {lane: OrderedDict() for lane in self.LANES}  # chat_id -> deque منتظرها
+        self._deficits = {lane: {} for lane in self.LANES}
+        self._stats = {
+            lane: {'granted': 0, 'timed_out': 0, 'total_wait': 0.0, 'max_wait': 0.0}
+            for lane in self.LANES
+        }
+    
+    def classify(self, cost: int) -> str:
+        return 'interactive' if cost <= self.interactive_max_cost else 'bulk'
+    
+    async def acquire(self, chat_id: str, cost: int, timeout: Optional[float] = None) -> str:
+        """انتظار برای نوبت در صف chat؛ در صورت اتمام timeout خطای asyncio.TimeoutError"""
+        cost = max(1, cost)
+        lane = self.classify(cost)
+        loop = asyncio.get_running_loop()
+        waiter = {
+            'chat_id': chat_id,
+            'lane': lane,
+            'cost': cost,
+            'loop': loop,
+            'future': loop.create_future(),
+            'enqueued_at': time.monotonic(),
+            'granted': False
+        }
+        
+        with self._lock:
+            self._queues[lane].setdefault(chat_id, deque()).append(waiter)
+            self._dispatch()
+        
         try:
-            client = Client()
-            client.set_endpoint(APPWRITE_ENDPOINT)
-            client.set_project(APPWRITE_PROJECT_ID)
-            client.set_key(APPWRITE_API_KEY)
+            await asyncio.wait_for(waiter['future'], timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            with self._lock:
+                granted = waiter['granted']
+                if not granted:
+                    self._remove_waiter(waiter)
+                    self._stats[lane]['timed_out'] += 1
+            if granted:
+                self.release()  # نوبت هم‌زمان با timeout داده شده بود
+            raise
+        return lane
+    
+    def release(self):
+        """آزاد کردن ظرفیت و دادن نوبت به منتظر بعدی"""
+        with self._lock:
+            self._active -= 1
+            self._dispatch()
+    
+    def _dispatch(self):
+        while self._active < self.max_concurrency:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
             
-            self._connection_pool[conn_id].update({
-                'client': client,
-                'databases': Databases(client),
-                'created_at': time.time()
-            })
-            print(f"اتصال {conn_id} تازه‌سازی شد")
-        except Exception as e:
-            print(f"خطا در تازه‌سازی اتصال {conn_id}: {e}")
-    
-    def _wait_for_connection(self):
-        """انتظار برای آزاد شدن اتصال"""
-        max_wait = 10  # حداکثر 10 ثانیه انتظار
-        wait_time = 0.1
-        total_wait = 0
-        
-        while total_wait < max_wait:
-            for conn_id, conn_info in self._connection_pool.items():
-                if not conn_info['in_use']:
-                    conn_info['in_use'] = True
-                    conn_info['last_used'] = time.time()
-                    return conn_id, conn_info['databases']
+            waiter['granted'] = True
+            self._active += 1
+            wait_time = time.monotonic() - waiter['enqueued_at']
+            stats = self._stats[waiter['lane']]
+            stats['granted'] += 1
+            stats['total_wait'] += wait_time
+            stats['max_wait'] = max(stats['max_wait'], wait_time)
             
-            time.sleep(wait_time)
-            total_wait += wait_time
-        
-        raise Exception("تمام اتصالات مشغول هستند")
+            try:
+                waiter['loop'].call_soon_threadsafe(self._wake, waiter['future'])
+            except RuntimeError:
+                # loop منتظر بسته شده است (invocation تمام شده)
+                self._active -= 1
     
-    def _release_connection(self, conn_id):
-        """آزاد کردن اتصال"""
-        if conn_id in self._connection_pool:
-            self._connection_pool[conn_id]['in_use'] = False
+    @staticmethod
+    def _wake(future):
+        if not future.done():
+            future.set_result(None)
     
-    def execute_with_retry(self, operation, *args, **kwargs):
-        """اجرای عملیات با retry logic"""
-        last_exception = None
+    def _next_waiter(self):
+        interactive_waiting = bool(self._queues['interactive'])
+        bulk_waiting = bool(self._queues['bulk'])
         
-        for attempt in range(self._retry_attempts):
-            conn_id = None
-            try:
-                conn_id, databases = self._get_available_connection()
-                
-                # اجرای عملیات
-                if operation == 'create_document':
-                    result = databases.create_document(*args, **kwargs)
-                elif operation == 'get_document':
-                    result = databases.get_document(*args, **kwargs)
-                elif operation == 'update_document':
-                    result = databases.update_document(*args, **kwargs)
-                elif operation == 'delete_document':
-                    result = databases.delete_document(*args, **kwargs)
-                elif operation == 'list_documents':
-                    result = databases.list_documents(*args, **kwargs)
-                else:
-                    raise ValueError(f"عملیات نامشخص: {operation}")
-                
-                return result
-                
-            except AppwriteException as e:
-                last_exception = e
-                print(f"تلاش {attempt + 1} ناموفق: {e}")
-                if attempt < self._retry_attempts - 1:
-                    time.sleep(0.5 * (attempt + 1))  # Exponential backoff
-            except Exception as e:
-                last_exception = e
-                print(f"خطای غیرمنتظره در تلاش {attempt + 1}: {e}")
-                break
-            finally:
-                if conn_id:
-                    self._release_connection(conn_id)
+        if interactive_waiting and (not bulk_waiting or self._interactive_streak < self.bulk_share):
+            self._interactive_streak += 1
+            return self._next_in_lane('interactive')
+        if bulk_waiting:
+            self._interactive_streak = 0
+            return self._next_in_lane('bulk')
+        return None
+    
+    def _next_in_lane(self, lane):
+        """انتخاب منتظر بعدی با Deficit Round Robin بین chatهای این lane"""
+        queues = self._queues[lane]
+        deficits = self._deficits[lane]
         
-        raise last_exception
+        while True:
+            chat_id, chat_queue = next(iter(queues.items()))
+            head = chat_queue[0]
+            if deficits.get(chat_id, 0) < head['cost']:
+                deficits[chat_id] = deficits.get(chat_id, 0) + self.quantum
+                if deficits[chat_id] < head['cost']:
+                    queues.move_to_end(chat_id)
+                    continue
+            
+            chat_queue.popleft()
+            deficits[chat_id] -= head['cost']
+            if not chat_queue:
+                del queues[chat_id]
+                del deficits[chat_id]
+            elif deficits[chat_id] < chat_queue[0]['cost']:
+                queues.move_to_end(chat_id)  # پایان نوبت این chat در این دور
+            return head
+    
+    def _remove_waiter(self, waiter):
+        queues = self._queues[waiter['lane']]
+        chat_queue = queues.get(waiter['chat_id'])
+        if chat_queue is None:
+            return
+        try:
+            chat_queue.remove(waiter)
+        except ValueError:
+            return
+        if not chat_queue:
+            del queues[waiter['chat_id']]
+            self._deficits[waiter['lane']].pop(waiter['chat_id'], None)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """عمق صف و زمان انتظار هر lane برای monitoring"""
+        with self._lock:
+            lanes = {}
+            for lane in self.LANES:
+                stats = self._stats[lane]
+                lanes[lane] = {
+                    'queue_depth': sum(len(chat_queue) for chat_queue in self._queues[lane].values()),
+                    'waiting_chats': len(self._queues[lane]),
+                    'granted': stats['granted'],
+                    'timed_out': stats['timed_out'],
+                    'avg_wait': round(stats['total_wait'] / stats['granted'], 4) if stats['granted'] else 0.0,
+                    'max_wait': round(stats['max_wait'], 4)
+                }
+            return {
+                'active': self._active,
+                'max_concurrency': self.max_concurrency,
+                'lanes': lanes
+            }
+
+class GeminiPromptCache:
+    """پیشوند ثابت درخواست‌های Gemini برای هر زبان
+    
+    SYSTEM_PROMPT همراه دستور زبان در systemInstruction قرار می‌گیرد و برای هر زبان یک
+    cachedContent ساخته و پیش از انقضا تمدید می‌شود تا توکن‌های پیشوند در هر درخواست
+    دوباره پردازش نشوند. ساخت و تمدید در thread پس‌زمینه انجام می‌شود؛ تا آماده شدن
+    cache (یا اگر مدل آن را نپذیرد، مثلاً چون prompt از حداقل اندازه cache کوتاه‌تر است)
+    systemInstruction مستقیماً در درخواست ارسال می‌شود. اگر سرور cache را به دلیل
+    کوچک بودن رد کند، برای آن زبان دیگر تلاشی برای ساخت cache انجام نمی‌شود. بدنه
+    درخواست‌ها از قبل serialize شده و فقط متن کاربر در آن جایگذاری می‌شود.
+    """
+    
+    _PLACEHOLDER = "\x00prompt\x00"
     
-    def health_check(self):
-        """بررسی سلامت اتصالات"""
-        current_time = time.time()
+    def __init__(self, ttl=3600, refresh_margin=300, retry_interval=600):
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._entries = {}  # user_lang -> وضعیت cache و بدنه‌های serialize شده
+        self._stats = {'created': 0, 'refreshed': 0, 'failed': 0, 'invalidated': 0, 'too_small': 0}
+    
+    @staticmethod
+    def system_instruction(user_lang: str) -> str:
+        lang_instruction = "\nYou MUST respond ONLY in Persian/Farsi." if user_lang == 'fa' else "\nYou MUST respond ONLY in English."
+        return SYSTEM_PROMPT + lang_instruction
+    
+    @classmethod
+    def _serialize(cls, payload):
+        """تقسیم بدنه JSON به پیشوند و پسوند اطراف متن کاربر"""
+        payload['contents'] = [{"role": "user", "parts": [{"text": cls._PLACEHOLDER}]}]
+        template = json.dumps(payload, ensure_ascii=False)
+        prefix, suffix = template.split(json.dumps(cls._PLACEHOLDER, ensure_ascii=False))
+        return prefix.encode('utf-8'), suffix.encode('utf-8')
+    
+    @staticmethod
+    def _api_parts():
+        """آدرس پایه API و نام مدل از روی GEMINI_API_URL (.../models/<model>:generateContent)"""
+        base, model_path = GEMINI_API_URL.split('/models/', 1)
+        return base, "models/" + model_path.split(':', 1)[0]
+    
+    def build_body(self, prompt: str, user_lang: str):
+        """بدنه آماده درخواست و نام cache استفاده شده (یا None)"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(user_lang)
+            if entry is None:
+                entry = {
+                    'inline': self._serialize({
+                        "systemInstruction": {"parts": [{"text": self.system_instruction(user_lang)}]}
+                    }),
+                    'cached': None,
+                    'retry_at': 0,
+                    'refreshing': False
+                }
+                self._entries[user_lang] = entry
+            
+            cached = entry['cached']
+            if (not entry['refreshing'] and now >= entry['retry_at'] and
+                    (cached is None or now >= cached['expires_at'] - self.refresh_margin)):
+                entry['refreshing'] = True
+                threading.Thread(target=self._refresh, args=(user_lang,), name='gemini-cache', daemon=True).start()
+            
+            if cached is not None and now < cached['expires_at'] - 30:  # حاشیه برای درخواست‌های در حال ارسال
+                prefix, suffix = cached['body']
+                cache_name = cached['name']
+            else:
+                prefix, suffix = entry['inline']
+                cache_name = None
         
-        if current_time - self._last_health_check < self._health_check_interval:
+        return prefix + json.dumps(prompt, ensure_ascii=False).encode('utf-8') + suffix, cache_name
+    
+    def _refresh(self, user_lang):
+        """ساخت cachedContent جدید یا تمدید cache فعلی"""
+        entry = self._entries[user_lang]
+        cached = entry['cached']
+        try:
+            base, model = self._api_parts()
+            if cached is not None and time.time() < cached['expires_at']:
+                response = requests.patch(
+                    f"{base}/{cached['name']}?key={GEMINI_API_KEY}&updateMask=ttl",
+                    json={"ttl": f"{self.ttl}s"},
+                    timeout=10
+                )
+                response.raise_for_status()
+                cached = {**cached, 'expires_at': time.time() + self.ttl}
+                stat = 'refreshed'
+            else:
+                response = requests.post(
+                    f"{base}/cachedContents?key={GEMINI_API_KEY}",
+                    json={
+                        "model": model,
+                        "displayName": f"pytech-system-{user_lang}",
+                        "systemInstruction": {"parts": [{"text": self.system_instruction(user_lang)}]},
+                        "ttl": f"{self.ttl}s"
+                    },
+                    timeout=10
+                )
+                if self._is_too_small(response):
+                    # با این prompt هیچ‌وقت cache ساخته نمی‌شود؛ تلاش دوباره فقط هزینه دارد
+                    with self._lock:
+                        entry['retry_at'] = float('inf')
+                        self._stats['too_small'] += 1
+                    log_event('gemini.context_cache_disabled', level='warning', user_lang=user_lang,
+                              error=response.text[:200])
+                    return
+                response.raise_for_status()
+                name = response.json()['name']
+                cached = {
+                    'name': name,
+                    'expires_at': time.time() + self.ttl,
+                    'body': self._serialize({"cachedContent": name})
+                }
+                stat = 'created'
+            
+            with self._lock:
+                entry['cached'] = cached
+                entry['retry_at'] = 0
+                self._stats[stat] += 1
+            log_event('gemini.context_cache_' + stat, user_lang=user_lang, cache_name=cached['name'])
+        except Exception as e:
+            with self._lock:
+                entry['retry_at'] = time.time() + self.retry_interval
+                self._stats['failed'] += 1
+            log_event('gemini.context_cache_failed', level='warning', user_lang=user_lang, error=str(e))
+        finally:
+            entry['refreshing'] = False
+    
+    @staticmethod
+    def _is_too_small(response) -> bool:
+        """رد ساخت cache به دلیل کمتر بودن توکن‌ها از حداقل اندازه cache"""
+        text = response.text.lower()
+        return response.status_code == 400 and ('too small' in text or 'min_total_token_count' in text)
+    
+    @staticmethod
+    def is_stale_cache_error(response, cache_name: str) -> bool:
+        """خطای درخواست به دلیل cache (حذف یا منقضی شده)، نه به دلیل خود prompt"""
+        if response.status_code in (403, 404):
             return True
+        return response.status_code == 400 and (cache_name in response.text or 'cachedcontent' in response.text.lower())
+    
+    def invalidate(self, user_lang: str, cache_name: str):
+        """کنار گذاشتن cacheی که سرور دیگر آن را نمی‌شناسد"""
+        with self._lock:
+            entry = self._entries.get(user_lang)
+            if entry is not None and entry['cached'] is not None and entry['cached']['name'] == cache_name:
+                entry['cached'] = None
+                self._stats['invalidated'] += 1
+    
+    def get_stats(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            return {
+                **self._stats,
+                'languages': {
+                    user_lang: {
+                        'cached': entry['cached'] is not None,
+                        'disabled': entry['retry_at'] == float('inf'),
+                        'expires_in': round(entry['cached']['expires_at'] - now) if entry['cached'] else None
+                    }
+                    for user_lang, entry in self._entries.items()
+                }
+            }
+
+
+class AdmissionController:
+    """کنترل پذیرش webhookها بر اساس بار فعلی نمونه
+    
+    سه سیگنال بررسی می‌شود: تعداد webhookهای در حال پردازش، میانگین اخیر انتظار برای
+    اتصال pool و میانگین اخیر latency پاسخ Gemini. میانگین‌ها با گذشت زمان کاهش
+    می‌یابند تا پس از رفع بار، پذیرش بدون نیاز به نمونه جدید از سر گرفته شود.
+    """
+    
+    def __init__(self, pool, max_in_flight=8, max_pool_wait=1.0, max_upstream_latency=8.0, half_life=10):
+        self.pool = pool
+        self.max_in_flight = max_in_flight
+        self.max_pool_wait = max_pool_wait
+        self.max_upstream_latency = max_upstream_latency
+        self.half_life = half_life
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._upstream_latency = 0.0
+        self._upstream_latency_at = 0.0
+        self._stats = {'admitted': 0, 'shed': 0, 'shed_in_flight': 0, 'shed_pool_wait': 0, 'shed_upstream_latency': 0}
+    
+    def try_admit(self) -> Optional[str]:
+        """پذیرش درخواست؛ در صورت رد شدن دلیل آن برگردانده می‌شود"""
+        pool_wait = self.pool.get_recent_wait()
+        with self._lock:
+            if self._in_flight >= self.max_in_flight:
+                reason = 'in_flight'
+            elif pool_wait > self.max_pool_wait:
+                reason = 'pool_wait'
+            elif self._get_upstream_latency() > self.max_upstream_latency:
+                reason = 'upstream_latency'
+            else:
+                self._in_flight += 1
+                self._stats['admitted'] += 1
+                return None
+            
+            self._stats['shed'] += 1
+            self._stats[f'shed_{reason}'] += 1
+            return reason
+    
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+    
+    def record_upstream_latency(self, latency: float):
+        """ثبت latency یک فراخوانی Gemini در میانگین اخیر"""
+        with self._lock:
+            self._upstream_latency = self._get_upstream_latency() * 0.8 + latency * 0.2
+            self._upstream_latency_at = time.time()
+    
+    def _get_upstream_latency(self):
+        elapsed = time.time() - self._upstream_latency_at
+        return self._upstream_latency * 0.5 ** (elapsed / self.half_life)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self._stats,
+                'in_flight': self._in_flight,
+                'recent_pool_wait': round(self.pool.get_recent_wait(), 4),
+                'recent_upstream_latency': round(self._get_upstream_latency(), 4)
+            }
+
+class RecoveryLeaseLost(Exception):
+    """lease پیام منقضی شده و ممکن است نمونه دیگری آن را گرفته باشد"""
+
+
+class RecoveryLease:
+    """lease یک پیام ناموفق تا فقط یک نمونه آن را بازیابی و ارسال کند
+    
+    Appwrite به‌روزرسانی شرطی ندارد؛ به جای آن گرفتن lease با ایجاد سند claim با
+    شناسه قطعی (شناسه پیام + نسل lease) انجام می‌شود که فقط یک نمونه در آن موفق
+    می‌شود و بقیه خطای 409 می‌گیرند. برنده پس از خواندن دوباره سند پیام، owner و
+    نسل و زمان انقضا را روی آن ثبت می‌کند. تمدید فقط پیش از انقضای محلی انجام می‌شود،
+    پس در آن لحظه نمونه دیگری نمی‌تواند lease را گرفته باشد.
+    
+    نسل lease هیچ‌وقت به عقب برنمی‌گردد (آزادسازی فقط owner و انقضا را پاک می‌کند) تا
+    شناسه claim دوباره استفاده نشود. claimها هم زمان انقضا دارند: اگر claimی رها شده
+    باشد (نمونه پیش از ثبت lease از کار افتاده یا حذف claim ناموفق بوده)، نمونه بعدی
+    نسل بعد از آن را claim می‌کند و پیام برای همیشه قفل نمی‌ماند.
+    """
+    
+    UNLEASED = {'lease_owner': '', 'lease_generation': 0, 'lease_expires_at': 0}
+    RELEASED = {'lease_owner': '', 'lease_expires_at': 0}
+    
+    def __init__(self, db, message_id, owner, generation, expires_at, ttl=30):
+        self.db = db
+        self.message_id = message_id
+        self.owner = owner
+        self.generation = generation
+        self.expires_at = expires_at
+        self.ttl = ttl
+    
+    @staticmethod
+    def claim_id(message_id: str, generation: int) -> str:
+        return "ls_" + hashlib.sha1(f"{message_id}:{generation}".encode('utf-8')).hexdigest()[:32]
+    
+    @classmethod
+    def try_acquire(cls, db, message_doc: Dict[str, Any], owner: str, ttl: float = 30,
+                    deadline: Optional[Deadline] = None) -> Optional['RecoveryLease']:
+        """تلاش برای گرفتن lease؛ اگر نمونه دیگری آن را دارد None"""
+        message_id = message_doc['$id']
+        if message_doc.get('lease_expires_at', 0) > time.time():
+            return None
         
-        healthy_connections = 0
-        for conn_id, conn_info in self._connection_pool.items():
+        base_generation = message_doc.get('lease_generation', 0)
+        generation = base_generation + 1
+        while True:
+            claim_expires_at = time.time() + ttl
             try:
-                # تست ساده اتصال
-                databases = conn_info['databases']
-                databases.list_documents(
+                db.execute_with_retry(
+                    'create_document',
                     database_id=APPWRITE_DATABASE_ID,
-                    collection_id=APPWRITE_COLLECTION_ID,
-                    queries=["limit(1)"]
+                    collection_id=APPWRITE_RECOVERY_LEASES_COLLECTION_ID,
+                    document_id=cls.claim_id(message_id, generation),
+                    data={'message_id': message_id, 'owner': owner, 'generation': generation,
+                          'expires_at': claim_expires_at},
+                    deadline=deadline
                 )
-                healthy_connections += 1
-            except Exception as e:
-                print(f"اتصال {conn_id} ناسالم: {e}")
-                self._refresh_connection(conn_id)
+                break
+            except AppwriteException as e:
+                if e.code != 409:
+                    raise
+            # نمونه دیگری همین نسل را گرفته است؛ فقط اگر claim آن رها شده نسل بعد امتحان می‌شود
+            if not cls._is_claim_abandoned(db, message_id, generation, deadline):
+                return None
+            generation += 1
+        
+        lease = cls(db, message_id, owner, generation, 0, ttl)
+        try:
+            # سند پیام ممکن است پس از list تغییر کرده باشد (پردازش یا گرفته شده توسط نمونه دیگر)
+            current = db.execute_with_retry(
+                'get_document',
+                database_id=APPWRITE_DATABASE_ID,
+                collection_id=APPWRITE_FAILED_MESSAGES_COLLECTION_ID,
+                document_id=message_id,
+                cache=False,
+                deadline=deadline
+            )
+            # پس از انقضای claim نمونه دیگری ممکن است نسل بعد را گرفته باشد
+            if (current.get('lease_generation', 0) != base_generation or
+                    current.get('lease_expires_at', 0) > time.time() or
+                    time.time() > claim_expires_at - RECOVERY_LEASE_CLOCK_SKEW):
+                lease.discard(deadline)
+                return None
+            
+            lease.expires_at = time.time() + ttl
+            db.execute_with_retry(
+                'update_document',
+                database_id=APPWRITE_DATABASE_ID,
+                collection_id=APPWRITE_FAILED_MESSAGES_COLLECTION_ID,
+                document_id=message_id,
+                data={'lease_owner': owner, 'lease_generation': generation, 'lease_expires_at': lease.expires_at},
+                deadline=deadline
+            )
+        except Exception as e:
+            # claim در هر خطایی (از جمله DeadlineExceeded) حذف می‌شود تا پیام قفل نماند
+            lease.discard(deadline)
+            if isinstance(e, AppwriteException) and e.code == 404:
+                return None  # پیام در این فاصله پردازش و حذف شده است
+            raise
         
-        self._last_health_check = current_time
-        health_ratio = healthy_connections / self._max_connections
+        # claim نسل قبل (از نمونه‌ای که lease آن منقضی شده) و claimهای رها شده دیگر لازم نیستند
+        for old_generation in range(max(base_generation, 1), generation):
+            lease._delete_claim(old_generation, deadline)
+        return lease
+    
+    @classmethod
+    def _is_claim_abandoned(cls, db, message_id: str, generation: int,
+                            deadline: Optional[Deadline] = None) -> bool:
+        """claim منقضی شده که lease آن هیچ‌وقت روی سند پیام ثبت نشده است"""
+        try:
+            claim = db.execute_with_retry(
+                'get_document',
+                database_id=APPWRITE_DATABASE_ID,
+                collection_id=APPWRITE_RECOVERY_LEASES_COLLECTION_ID,
+                document_id=cls.claim_id(message_id, generation),
+                cache=False,
+                deadline=deadline
+            )
+        except AppwriteException as e:
+            if e.code == 404:
+                return True  # claim در این فاصله حذف شده است
+            raise
+        # claimهای قدیمی بدون expires_at هم رها شده حساب می‌شوند
+        return claim.get('expires_at', 0) + RECOVERY_LEASE_CLOCK_SKEW < time.time()
+    
+    def is_held(self) -> bool:
+        return time.time() < self.expires_at - RECOVERY_LEASE_CLOCK_SKEW
+    
+    def renew_if_needed(self, deadline: Optional[Deadline] = None):
+        """تمدید lease پیش از ورود به نیمه دوم مدت اعتبار"""
+        if not self.is_held():
+            raise RecoveryLeaseLost(f"lease پیام {self.message_id} منقضی شده است")
+        if self.expires_at - time.time() > self.ttl / 2:
+            return
         
-        print(f"Health check: {healthy_connections}/{self._max_connections} اتصال سالم")
-        return health_ratio > 0.5  # حداقل 50% اتصالات باید سالم باشند
+        expires_at = time.time() + self.ttl
+        self.db.execute_with_retry(
+            'update_document',
+            database_id=APPWRITE_DATABASE_ID,
+            collection_id=APPWRITE_FAILED_MESSAGES_COLLECTION_ID,
+            document_id=self.message_id,
+            data={'lease_expires_at': expires_at},
+            deadline=deadline
+        )
+        self.expires_at = expires_at
+    
+    def release_operations(self, data: Optional[Dict[str, Any]] = None) -> list:
+        """عملیات آزادسازی lease (همراه با تغییرات دیگر سند پیام) برای execute_many"""
+        return [
+            ('update_document', {
+                'database_id': APPWRITE_DATABASE_ID,
+                'collection_id': APPWRITE_FAILED_MESSAGES_COLLECTION_ID,
+                'document_id': self.message_id,
+                'data': {**(data or {}), **self.RELEASED}
+            }),
+            self.claim_delete_operation()
+        ]
+    
+    def claim_delete_operation(self):
+        return ('delete_document', {
+            'database_id': APPWRITE_DATABASE_ID,
+            'collection_id': APPWRITE_RECOVERY_LEASES_COLLECTION_ID,
+            'document_id': self.claim_id(self.message_id, self.generation)
+        })
+    
+    def discard(self, deadline: Optional[Deadline] = None):
+        """حذف claim بدون تغییر سند پیام (وقتی lease گرفته نشد)"""
+        # ممکن است پس از DeadlineExceeded صدا زده شود؛ از reserve مسیر خطا استفاده می‌کند
+        self._delete_claim(self.generation, deadline.for_failure_path() if deadline is not None else None)
+    
+    def _delete_claim(self, generation, deadline):
+        try:
+            self.db.execute_with_retry(
+                'delete_document',
+                database_id=APPWRITE_DATABASE_ID,
+                collection_id=APPWRITE_RECOVERY_LEASES_COLLECTION_ID,
+                document_id=self.claim_id(self.message_id, generation),
+                deadline=deadline
+            )
+        except Exception as e:
+            # claim باقی‌مانده پس از انقضا توسط نمونه بعدی نادیده گرفته و حذف می‌شود
+            if getattr(e, 'code', None) != 404:
+                log_event('recovery.claim_delete_failed', level='warning',
+                          document_id=self.message_id, error=str(e))
 
-# نمونه سراسری از کلاس اتصال
+# نمونه سراسری از کلاس اتصال (همان singleton و pool مشترک enhanced_database)
 db_manager = EnhancedDatabaseConnection()
+failed_message_spool = FailedMessageSpool(FAILED_MESSAGES_SPOOL_PATH)
+_spool_recovery_lock = threading.Lock()
+gemini_scheduler = GeminiScheduler(
+    GEMINI_MAX_CONCURRENCY,
+    quantum=GEMINI_SCHEDULER_QUANTUM,
+    interactive_max_cost=GEMINI_INTERACTIVE_MAX_CHARS,
+    bulk_share=GEMINI_BULK_SHARE
+)
+gemini_prompt_cache = GeminiPromptCache(
+    ttl=GEMINI_CONTEXT_CACHE_TTL,
+    refresh_margin=GEMINI_CONTEXT_CACHE_REFRESH_MARGIN,
+    retry_interval=GEMINI_CONTEXT_CACHE_RETRY_INTERVAL
+)
+admission_controller = AdmissionController(
+    db_manager,
+    max_in_flight=ADMISSION_MAX_IN_FLIGHT,
+    max_pool_wait=ADMISSION_MAX_POOL_WAIT,
+    max_upstream_latency=ADMISSION_MAX_UPSTREAM_LATENCY,
+    half_life=ADMISSION_SIGNAL_HALF_LIFE
+)
+
+# process pool مراحل CPU-bound (workerها در اولین invocation گرم می‌شوند)
+cpu_pool = CpuWorkerPool(CPU_POOL_WORKERS, SHARED_MEMORY_MIN_BYTES)
 
 # توابع کمکی برای پردازش فوری
+def request_timeout(deadline: Optional[Deadline], cap: float) -> float:
+    """timeout یک درخواست HTTP بیرونی بر اساس بودجه باقی‌مانده درخواست"""
+    if deadline is None:
+        return cap
+    if deadline.expired():
+        raise DeadlineExceeded("بودجه زمانی درخواست تمام شده است")
+    return deadline.timeout(cap)
+
 async def validate_telegram_update(req) -> Dict[str, Any]:
     """اعتبارسنجی و استخراج داده‌های تلگرام"""
     try:
@@ -238,36 +832,47 @@ async def extract_message_data(update: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 async def detect_user_language(text: str) -> str:
-    """تشخیص زبان کاربر"""
+    """تشخیص زبان کاربر (در process pool تا event loop مسدود نشود)"""
+    if not text:
+        return 'en'
     try:
-        return langdetect.detect(text) if text else 'en'
-    except:
+        return await cpu_pool.detect_language(text)
+    except Exception:
         return 'en'
 
-async def get_gemini_response_async(prompt: str, user_lang: str) -> str:
+async def get_gemini_response_async(prompt: str, user_lang: str, deadline: Optional[Deadline] = None) -> str:
     """دریافت پاسخ از API هوش مصنوعی Gemini به صورت async"""
     headers = {'Content-Type': 'application/json'}
     
-    lang_instruction = "\nYou MUST respond ONLY in Persian/Farsi." if user_lang == 'fa' else "\nYou MUST respond ONLY in English."
-    modified_prompt = SYSTEM_PROMPT + lang_instruction
-    
-    data = {
-        "contents": [{
-            "parts": [
-                {"text": modified_prompt},
-                {"text": prompt}
-            ]
-        }]
-    }
+    # systemInstruction (یا cachedContent آن) در بدنه از پیش serialize شده هر زبان قرار دارد
+    body, cache_name = gemini_prompt_cache.build_body(prompt, user_lang)
     
     try:
-        # استفاده از requests برای درخواست HTTP
-        response = requests.post(
-            f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
-            headers=headers,
-            json=data,
-            timeout=15  # timeout برای جلوگیری از انتظار طولانی
-        )
+        # درخواست HTTP در thread جداگانه تا event loop برای منتظرهای زمان‌بند آزاد بماند
+        loop = asyncio.get_running_loop()
+        started_at = time.time()
+        try:
+            response = await loop.run_in_executor(None, functools.partial(
+                requests.post,
+                f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
+                headers=headers,
+                data=body,
+                timeout=request_timeout(deadline, 15)  # timeout برای جلوگیری از انتظار طولانی
+            ))
+            if cache_name is not None and gemini_prompt_cache.is_stale_cache_error(response, cache_name):
+                # cache در سمت سرور حذف یا منقضی شده است؛ ارسال دوباره با systemInstruction
+                # (400 مربوط به خود prompt، مثلاً prompt بیش از حد بزرگ، cache را باطل نمی‌کند)
+                gemini_prompt_cache.invalidate(user_lang, cache_name)
+                body, cache_name = gemini_prompt_cache.build_body(prompt, user_lang)
+                response = await loop.run_in_executor(None, functools.partial(
+                    requests.post,
+                    f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
+                    headers=headers,
+                    data=body,
+                    timeout=request_timeout(deadline, 15)
+                ))
+        finally:
+            admission_controller.record_upstream_latency(time.time() - started_at)
         response.raise_for_status()
         result = response.json()
         
@@ -278,79 +883,293 @@ async def get_gemini_response_async(prompt: str, user_lang: str) -> str:
         error_msg = f"خطا در دریافت پاسخ: {str(e)}" if user_lang == 'fa' else f"Error getting response: {str(e)}"
         return error_msg
 
-async def send_telegram_message_async(chat_id: str, text: str) -> bool:
-    """ارسال پیام به تلگرام به صورت async"""
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+def scheduler_wait_timeout(deadline: Optional[Deadline]) -> float:
+    """حداکثر انتظار در صف gemini_scheduler؛ GEMINI_MIN_CALL_BUDGET برای خود فراخوانی می‌ماند
     
+    اگر همین حالا هم بودجه کافی نمانده باشد asyncio.TimeoutError (بدون ورود به صف)
+    """
+    if deadline is None:
+        return REQUEST_DEADLINE
+    wait_timeout = deadline.remaining() - GEMINI_MIN_CALL_BUDGET
+    if wait_timeout <= 0:
+        raise asyncio.TimeoutError()
+    return wait_timeout
+
+async def get_gemini_response_scheduled(chat_id: str, prompt: str, user_lang: str,
+                                        deadline: Optional[Deadline] = None) -> str:
+    """دریافت پاسخ Gemini با عبور از صف عادلانه chat در gemini_scheduler"""
     try:
-        # تقسیم پیام‌های طولانی
-        max_length = 4096
-        if len(text) > max_length:
-            chunks = [text[i:i + max_length] for i in range(0, len(text), max_length)]
-            for chunk in chunks:
-                response = requests.post(
-                    url, 
-                    json={"chat_id": chat_id, "text": chunk},
-                    timeout=10
-                )
-                if not response.ok:
-                    print(f"خطا در ارسال بخش پیام: {response.text}")
-        else:
+        await gemini_scheduler.acquire(chat_id, len(prompt), scheduler_wait_timeout(deadline))
+    except asyncio.TimeoutError:
+        log_event('gemini.schedule_timeout', level='warning', chat_id=chat_id, prompt_chars=len(prompt))
+        return "سرور در حال حاضر شلوغ است، لطفاً کمی بعد دوباره تلاش کنید." if user_lang == 'fa' else "The server is busy right now, please try again shortly."
+    
+    try:
+        return await get_gemini_response_async(prompt, user_lang, deadline)
+    finally:
+        gemini_scheduler.release()
+
+async def summarize_conversation_async(chat_id: str, previous_summary: str, turns: list,
+                                       deadline: Optional[Deadline] = None) -> str:
+    """تولید خلاصه جدید از خلاصه قبلی و نوبت‌های قدیمی (در صورت خطا exception)"""
+    transcript = "\n\n".join(f"User: {turn['message']}\nPyTech: {turn['response']}" for turn in turns)
+    prompt = COMPACTION_PROMPT.format(
+        max_chars=SUMMARY_MAX_CHARS,
+        summary=previous_summary or "-",
+        transcript=transcript
+    )
+    
+    # promptهای بلند خلاصه‌سازی در lane bulk زمان‌بند قرار می‌گیرند
+    await gemini_scheduler.acquire(chat_id, len(prompt), scheduler_wait_timeout(deadline))
+    try:
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(None, functools.partial(
+            requests.post,
+            f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
+            headers={'Content-Type': 'application/json'},
+            json={"contents": [{"parts": [{"text": prompt}]}]},
+            timeout=request_timeout(deadline, 30)
+        ))
+        response.raise_for_status()
+        return response.json()['candidates'][0]['content']['parts'][0]['text']
+    finally:
+        gemini_scheduler.release()
+
+_CODE_BLOCK_PATTERN = re.compile(r"```[ \t]*([\w+-]*)[ \t]*\n(.*?)```", re.DOTALL)
+_CODE_FILENAME_PATTERN = re.compile(r"#\s*([\w\-]+\.py)\s*$")
+
+def extract_code_files(text: str):
+    """جدا کردن بلوک‌های کد Python از پاسخ به صورت فایل‌های .py در حافظه
+    
+    خروجی (متن باقی‌مانده، [(نام فایل، محتوا)]) است؛ بلوک‌های کوتاه یا غیر Python
+    در متن باقی می‌مانند و جای هر فایل با نام آن مشخص می‌شود. بلوک بدون برچسب زبان
+    فقط اگر کد Python معتبر باشد فایل می‌شود (نه دستورات shell، traceback یا خروجی
+    برنامه). اگر خط اول بلوک کامنتی مثل "# utils.py" باشد از همان نام استفاده می‌شود.
+    """
+    files = []
+    
+    def replace(match):
+        language, code = match.group(1).lower(), match.group(2)
+        if language not in ('', 'python', 'py', 'python3') or code.count("\n") < CODE_FILE_MIN_LINES:
+            return match.group(0)
+        if not language and not _is_python_source(code):
+            return match.group(0)
+        
+        first_line = code.split("\n", 1)[0]
+        name_match = _CODE_FILENAME_PATTERN.match(first_line.strip())
+        filename = name_match.group(1) if name_match else f"code_{len(files) + 1}.py"
+        if any(existing == filename for existing, _ in files):
+            filename = f"{filename[:-3]}_{len(files) + 1}.py"
+        files.append((filename, code))
+        return f"📎 {filename}"
+    
+    prose = _CODE_BLOCK_PATTERN.sub(replace, text)
+    return prose.strip(), files
+
+def _is_python_source(code: str) -> bool:
+    try:
+        ast.parse(code)
+        return True
+    except (SyntaxError, ValueError):
+        return False
+
+async def _send_text_message(chat_id: str, text: str, deadline: Optional[Deadline] = None) -> bool:
+    """ارسال متن با sendMessage (پیام‌های طولانی چند تکه می‌شوند)"""
+    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+    
+    # تقسیم پیام‌های طولانی
+    max_length = TELEGRAM_MESSAGE_LIMIT
+    if len(text) > max_length:
+        chunks = [text[i:i + max_length] for i in range(0, len(text), max_length)]
+        for chunk in chunks:
             response = requests.post(
                 url, 
-                json={"chat_id": chat_id, "text": text},
-                timeout=10
+                json={"chat_id": chat_id, "text": chunk},
+                timeout=request_timeout(deadline, 10)
             )
             if not response.ok:
-                print(f"خطا در ارسال پیام: {response.text}")
+                log_event('telegram.send_chunk_failed', level='error', status=response.status_code,
+                          response=response.text)
+    else:
+        response = requests.post(
+            url, 
+            json={"chat_id": chat_id, "text": text},
+            timeout=request_timeout(deadline, 10)
+        )
+        if not response.ok:
+            log_event('telegram.send_failed', level='error', status=response.status_code,
+                      response=response.text)
+            return False
+    
+    return True
+
+async def _send_code_files(chat_id: str, files: list, caption: str = '',
+                           deadline: Optional[Deadline] = None) -> list:
+    """ارسال فایل‌های کد با یک درخواست multipart (sendDocument یا sendMediaGroup)
+    
+    فایل‌های گروه‌هایی که ارسالشان ناموفق بوده برگردانده می‌شوند (لیست خالی یعنی همه ارسال شدند).
+    """
+    failed_files = []
+    for start in range(0, len(files), TELEGRAM_MEDIA_GROUP_LIMIT):
+        group = files[start:start + TELEGRAM_MEDIA_GROUP_LIMIT]
+        # caption فقط همراه آخرین فایل ارسال می‌شود تا بعد از کدها نمایش داده شود
+        is_last_group = start + TELEGRAM_MEDIA_GROUP_LIMIT >= len(files)
+        group_caption = caption if is_last_group else ''
+        
+        try:
+            if len(group) == 1:
+                filename, code = group[0]
+                data = {"chat_id": chat_id}
+                if group_caption:
+                    data["caption"] = group_caption
+                response = requests.post(
+                    f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendDocument",
+                    data=data,
+                    files={"document": (filename, code.encode('utf-8'), 'text/x-python')},
+                    timeout=request_timeout(deadline, 15)
+                )
+            else:
+                media = [
+                    {"type": "document", "media": f"attach://file{index}"}
+                    for index in range(len(group))
+                ]
+                if group_caption:
+                    media[-1]["caption"] = group_caption
+                response = requests.post(
+                    f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMediaGroup",
+                    data={"chat_id": chat_id, "media": json.dumps(media, ensure_ascii=False)},
+                    files={
+                        f"file{index}": (filename, code.encode('utf-8'), 'text/x-python')
+                        for index, (filename, code) in enumerate(group)
+                    },
+                    timeout=request_timeout(deadline, 15)
+                )
+        except requests.RequestException as e:
+            log_event('telegram.send_files_failed', level='error', files=len(group), error=str(e))
+            failed_files += group
+            continue
+        
+        if not response.ok:
+            log_event('telegram.send_files_failed', level='error', status=response.status_code,
+                      files=len(group), response=response.text)
+            failed_files += group
+    
+    return failed_files
+
+async def send_telegram_message_async(chat_id: str, text: str, deadline: Optional[Deadline] = None) -> bool:
+    """ارسال پیام به تلگرام به صورت async
+    
+    بلوک‌های کد Python پاسخ به صورت فایل .py ارسال می‌شوند و متن توضیحات در صورت
+    امکان به عنوان caption همان درخواست فرستاده می‌شود.
+    """
+    try:
+        prose, files = extract_code_files(text)
+        if not files:
+            return await _send_text_message(chat_id, text, deadline)
+        
+        caption = prose if len(prose) <= TELEGRAM_CAPTION_LIMIT else ''
+        if prose and not caption:
+            # توضیحات طولانی در یک پیام جداگانه و قبل از فایل‌ها ارسال می‌شود
+            if not await _send_text_message(chat_id, prose, deadline):
                 return False
         
-        return True
+        failed_files = await _send_code_files(chat_id, files, caption, deadline)
+        if not failed_files:
+            return True
+        
+        # فقط فایل‌های گروه‌های ناموفق به صورت متن ارسال می‌شوند (caption همراه گروه آخر است)
+        fallback_text = "\n\n".join(f"{filename}\n```python\n{code}```" for filename, code in failed_files)
+        if caption and files[-1] in failed_files:
+            fallback_text = f"{caption}\n\n{fallback_text}"
+        return await _send_text_message(chat_id, fallback_text, deadline)
     except Exception as e:
-        print(f"خطا در ارسال پیام به تلگرام: {e}")
+        log_event('telegram.send_error', level='error', error=str(e))
         return False
 
-async def save_conversation_async(chat_id: str, message: str, response: str) -> bool:
-    """ذخیره مکالمه به صورت async"""
+def recovery_shard(chat_id: str) -> int:
+    """shard ثابت هر chat برای تقسیم پیام‌های ناموفق بین نمونه‌های recovery"""
+    return zlib.crc32(str(chat_id).encode('utf-8')) % RECOVERY_SHARDS
+
+async def save_failed_message(chat_id: str, message_data: Dict[str, Any], error: str,
+                              deadline: Optional[Deadline] = None) -> bool:
+    """ذخیره پیام ناموفق برای پردازش بعدی
+    
+    پیام ابتدا در spool محلی نوشته می‌شود (بدون وابستگی به Appwrite) و بعداً توسط
+    drain_failed_message_spool به collection پیام‌های ناموفق منتقل می‌شود. فقط اگر
+    نوشتن در spool ممکن نباشد، مستقیماً در Appwrite ذخیره می‌شود.
+    """
+    record = {
+        'chat_id': chat_id,
+        'message_data': json.dumps(message_data),
+        'error': error,
+        'retry_count': 0,
+        'shard': recovery_shard(chat_id)
+    }
+    
     try:
-        result = db_manager.execute_with_retry(
-            'create_document',
-            database_id=APPWRITE_DATABASE_ID,
-            collection_id=APPWRITE_COLLECTION_ID,
-            document_id='unique()',
-            data={
-                'user_id': chat_id,
-                'message': message,
-                'response': response,
-                'timestamp': {'$createdAt': True}
-            }
-        )
+        failed_message_spool.append(record)
         return True
     except Exception as e:
-        print(f"خطا در ذخیره مکالمه: {e}")
-        return False
-
-async def save_failed_message(chat_id: str, message_data: Dict[str, Any], error: str) -> bool:
-    """ذخیره پیام ناموفق برای پردازش بعدی"""
+        log_event('spool.append_failed', level='error', error=str(e))
+    
     try:
         result = db_manager.execute_with_retry(
             'create_document',
             database_id=APPWRITE_DATABASE_ID,
             collection_id=APPWRITE_FAILED_MESSAGES_COLLECTION_ID,
             document_id='unique()',
-            data={
-                'chat_id': chat_id,
-                'message_data': json.dumps(message_data),
-                'error': error,
-                'retry_count': 0,
-                'timestamp': {'$createdAt': True}
-            }
+            data={**record, **RecoveryLease.UNLEASED, 'timestamp': {'$createdAt': True}},
+            deadline=deadline.for_failure_path() if deadline is not None else None
         )
         return True
     except Exception as e:
-        print(f"خطا در ذخیره پیام ناموفق: {e}")
+        log_event('db.save_failed_message_failed', level='error', error=str(e))
         return False
 
+def _spooled_message_operation(record: Dict[str, Any]):
+    """عملیات ایجاد سند پیام ناموفق برای یک رکورد spool"""
+    return ('create_document', {
+        'database_id': APPWRITE_DATABASE_ID,
+        'collection_id': APPWRITE_FAILED_MESSAGES_COLLECTION_ID,
+        # شناسه spool به عنوان شناسه سند، ارسال دوباره را بی‌اثر می‌کند (خطای 409)
+        'document_id': record['spool_id'],
+        'data': {
+            'chat_id': record['chat_id'],
+            'message_data': record['message_data'],
+            'error': record['error'],
+            'retry_count': record.get('retry_count', 0),
+            'shard': record.get('shard', recovery_shard(record['chat_id'])),
+            **RecoveryLease.UNLEASED,
+            'timestamp': {'$createdAt': True}
+        }
+    })
+
+async def drain_failed_message_spool(deadline: Optional[Deadline] = None) -> int:
+    """انتقال پیام‌های spool شده به Appwrite در صورت در دسترس بودن دیتابیس"""
+    records = failed_message_spool.read_all()
+    if not records:
+        return 0
+    
+    def forwarded(item):
+        return item['success'] or getattr(item['error'], 'code', None) == 409
+    
+    # ابتدا یک رکورد ارسال می‌شود؛ اگر Appwrite هنوز در دسترس نیست بقیه ارسال نمی‌شوند
+    results = await db_manager.execute_many_async([_spooled_message_operation(records[0])], deadline=deadline)
+    if not forwarded(results[0]):
+        log_event('spool.drain_skipped', level='warning', pending=len(records), error=str(results[0]['error']))
+        return 0
+    
+    results += await db_manager.execute_many_async(
+        [_spooled_message_operation(record) for record in records[1:]],
+        deadline=deadline
+    )
+    
+    drained_ids = [record['spool_id'] for record, item in zip(records, results) if forwarded(item)]
+    failed_message_spool.remove(drained_ids)
+    
+    log_event('spool.drained', drained=len(drained_ids), remaining=len(records) - len(drained_ids))
+    return len(drained_ids)
+
 # توابع پردازش پیام‌ها
 async def handle_start_command_async(chat_id: str, text: str) -> str:
     """پردازش دستور /start"""
@@ -388,26 +1207,34 @@ async def handle_help_command_async(chat_id: str, text: str) -> str:
     
     return message
 
-async def handle_document_async(chat_id: str, file_id: str, mime_type: str, caption: str = None) -> str:
+async def handle_document_async(chat_id: str, file_id: str, mime_type: str, caption: str = None,
+                                deadline: Optional[Deadline] = None) -> str:
     """پردازش فایل‌های دریافتی"""
     if mime_type == 'text/x-python':
         try:
             # دریافت فایل از تلگرام
             file_info_url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getFile?file_id={file_id}"
-            file_info_response = requests.get(file_info_url, timeout=10)
+            file_info_response = requests.get(file_info_url, timeout=request_timeout(deadline, 10))
             file_info = file_info_response.json()
             
             if 'result' in file_info and 'file_path' in file_info['result']:
                 file_path = file_info['result']['file_path']
                 file_url = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_path}"
-                file_response = requests.get(file_url, timeout=15)
+                file_response = requests.get(file_url, timeout=request_timeout(deadline, 15))
+                
+                # متن فایل همین‌جا decode می‌شود؛ بررسی syntax و تشخیص زبان کاربر هم‌زمان در process pool
                 code = file_response.content.decode('utf-8')
+                syntax_error, user_lang = await asyncio.gather(
+                    cpu_pool.find_syntax_error(file_response.content),
+                    detect_user_language(caption or '')
+                )
                 
-                # تشخیص زبان کاربر
-                user_lang = await detect_user_language(caption) if caption else 'en'
+                prompt = f"Review this Python code:\n{code}"
+                if syntax_error:
+                    prompt = f"The file does not parse ({syntax_error}).\n{prompt}"
                 
                 # دریافت پاسخ از Gemini
-                ai_response = await get_gemini_response_async(f"Review this Python code:\n{code}", user_lang)
+                ai_response = await get_gemini_response_scheduled(chat_id, prompt, user_lang, deadline)
                 return ai_response
             else:
                 return "خطا در دریافت فایل از تلگرام" if await detect_user_language(caption or '') == 'fa' else "Error downloading file from Telegram"
@@ -418,13 +1245,13 @@ async def handle_document_async(chat_id: str, file_id: str, mime_type: str, capt
         user_lang = await detect_user_language(caption or '')
         return "لطفاً فقط فایل‌های Python (.py) ارسال کنید" if user_lang == 'fa' else "Please send only Python (.py) files"
 
-async def handle_text_message_async(chat_id: str, text: str) -> str:
+async def handle_text_message_async(chat_id: str, text: str, deadline: Optional[Deadline] = None) -> str:
     """پردازش پیام‌های متنی"""
     user_lang = await detect_user_language(text)
-    ai_response = await get_gemini_response_async(text, user_lang)
+    ai_response = await get_gemini_response_scheduled(chat_id, text, user_lang, deadline)
     return ai_response
 
-async def process_message_immediately(update: Dict[str, Any]) -> Dict[str, Any]:
+async def process_message_immediately(update: Dict[str, Any], deadline: Optional[Deadline] = None) -> Dict[str, Any]:
     """پردازش فوری پیام"""
     message_data = await extract_message_data(update)
     chat_id = message_data['chat_id']
@@ -439,7 +1266,7 @@ async def process_message_immediately(update: Dict[str, Any]) -> Dict[str, Any]:
             elif text.startswith('/help'):
                 response = await handle_help_command_async(chat_id, text)
             else:
-                response = await handle_text_message_async(chat_id, text)
+                response = await handle_text_message_async(chat_id, text, deadline)
                 
         elif message_data['document']:
             document = message_data['document']
@@ -447,7 +1274,8 @@ async def process_message_immediately(update: Dict[str, Any]) -> Dict[str, Any]:
                 chat_id, 
                 document['file_id'], 
                 document.get('mime_type', ''), 
-                message_data['caption']
+                message_data['caption'],
+                deadline
             )
         else:
             user_lang = await detect_user_language(message_data.get('caption', ''))
@@ -470,49 +1298,61 @@ async def process_message_immediately(update: Dict[str, Any]) -> Dict[str, Any]:
         }
 
 # تابع اصلی webhook با قابلیت real-time
-async def main_webhook_realtime(req, res):
+async def main_webhook_realtime(req, res, deadline: Optional[Deadline] = None):
     """تابع اصلی webhook با پردازش real-time"""
     start_time = time.time()
+    if deadline is None:
+        deadline = Deadline(REQUEST_DEADLINE, reserve=FAILURE_PATH_RESERVE)
+    log_token = None
     
     try:
         # اعتبارسنجی داده‌های ورودی
         update = await validate_telegram_update(req)
         
+        # فیلدهای correlation برای ردیابی تمام لاگ‌های این update
+        log_token = bind_log_context(
+            update_id=update.get('update_id'),
+            chat_id=str(update['message']['chat']['id'])
+        )
+        
         # پردازش فوری پیام
-        result = await process_message_immediately(update)
+        result = await process_message_immediately(update, deadline)
         
         # ارسال پاسخ به کاربر
         if result['success']:
-            send_success = await send_telegram_message_async(result['chat_id'], result['response'])
+            send_success = await send_telegram_message_async(result['chat_id'], result['response'], deadline)
             
             if send_success:
                 # ذخیره مکالمه در background (non-blocking)
                 asyncio.create_task(save_conversation_async(
                     result['chat_id'],
                     result['message_data'].get('text', '[File/Document]'),
-                    result['response']
+                    result['response'],
+                    deadline
                 ))
             else:
                 # در صورت خطا در ارسال، ذخیره در failed messages
                 await save_failed_message(
                     result['chat_id'],
                     result['message_data'],
-                    "Failed to send response to Telegram"
+                    "Failed to send response to Telegram",
+                    deadline
                 )
         else:
             # ارسال پیام خطا به کاربر
             error_response = "متأسفم، خطایی رخ داده است. لطفاً دوباره تلاش کنید."
-            await send_telegram_message_async(result['chat_id'], error_response)
+            await send_telegram_message_async(result['chat_id'], error_response, deadline)
             
             # ذخیره در failed messages
             await save_failed_message(
                 result['chat_id'],
                 result['message_data'],
-                result.get('error', 'Unknown error')
+                result.get('error', 'Unknown error'),
+                deadline
             )
         
         processing_time = time.time() - start_time
-        print(f"پیام در {processing_time:.2f} ثانیه پردازش شد")
+        log_event('webhook.processed', processing_time=round(processing_time, 3), success=result['success'])
         
         return res.json({
             "success": True,
@@ -522,92 +1362,280 @@ async def main_webhook_realtime(req, res):
         
     except Exception as e:
         processing_time = time.time() - start_time
-        print(f"خطا در پردازش webhook: {str(e)}")
+        log_event('webhook.failed', level='error', processing_time=round(processing_time, 3), error=str(e))
         
         return res.json({
             "success": False,
             "error": str(e),
             "processing_time": processing_time
         }, 500)
+    
+    finally:
+        if log_token is not None:
+            reset_log_context(log_token)
+
+async def shed_webhook_request(req, res, reason: str, deadline: Optional[Deadline] = None):
+    """پاسخ سریع به update در زمان بار زیاد، بدون فراخوانی Gemini
+    
+    دستورات از قالب‌های محلی پاسخ داده می‌شوند و بقیه پیام‌ها در صف پیام‌های ناموفق
+    قرار می‌گیرند تا recovery بعداً پردازششان کند. پاسخ در بدنه webhook (method=sendMessage)
+    برگردانده می‌شود تا درخواست خروجی اضافه‌ای لازم نباشد و تلگرام update را دوباره نفرستد.
+    """
+    try:
+        update = await validate_telegram_update(req)
+        message_data = await extract_message_data(update)
+    except Exception as e:
+        log_event('webhook.shed_invalid', level='warning', reason=reason, error=str(e))
+        return res.json({"success": False, "error": str(e)})
+    
+    chat_id = message_data['chat_id']
+    text = message_data['text'] or ''
+    
+    if text.startswith('/start'):
+        reply = await handle_start_command_async(chat_id, text)
+    elif text.startswith('/help'):
+        reply = await handle_help_command_async(chat_id, text)
+    else:
+        if not await save_failed_message(chat_id, message_data, f"Shed under load: {reason}", deadline):
+            # امکان صف کردن نبود؛ تلگرام update را بعداً دوباره ارسال می‌کند
+            return res.json({"success": False, "error": "overloaded"}, 503)
+        user_lang = await detect_user_language(text or message_data['caption'] or '')
+        reply = "سرور در حال حاضر شلوغ است؛ پیام شما ثبت شد و به‌زودی پاسخ داده می‌شود." if user_lang == 'fa' \
+            else "The server is busy right now; your message was queued and will be answered shortly."
+    
+    log_event('webhook.shed', level='warning', chat_id=chat_id, reason=reason)
+    return res.json({"method": "sendMessage", "chat_id": chat_id, "text": reply})
 
 # تابع بازیابی پیام‌های ناموفق
-async def recovery_function(req, res):
-    """پردازش پیام‌های ناموفق"""
+async def recovery_function(req, res, deadline: Optional[Deadline] = None):
+    """پردازش پیام‌های ناموفق (از Appwrite و spool محلی)
+    
+    چند نمونه می‌توانند هم‌زمان اجرا شوند: هر اجرا shardها را از نقطه‌ای تصادفی
+    (یا shard مشخص شده در query) پیمایش می‌کند و هر پیام را فقط پس از گرفتن lease
+    پردازش می‌کند تا پاسخ تکراری ارسال نشود.
+    """
+    if deadline is None:
+        deadline = Deadline(REQUEST_DEADLINE, reserve=FAILURE_PATH_RESERVE)
+    
+    owner = uuid.uuid4().hex
+    # spool محلی فقط توسط یک اجرای recovery در هر نمونه پردازش می‌شود
+    spool_claimed = _spool_recovery_lock.acquire(blocking=False)
+    
     try:
-        # دریافت پیام‌های ناموفق
-        result = db_manager.execute_with_retry(
-            'list_documents',
-            database_id=APPWRITE_DATABASE_ID,
-            collection_id=APPWRITE_FAILED_MESSAGES_COLLECTION_ID,
-            queries=["retry_count<3", "orderAsc('timestamp')", "limit(10)"]
-        )
+        # انتقال پیام‌های spool شده به Appwrite (در صورت در دسترس بودن دیتابیس)
+        drained_count = await drain_failed_message_spool(deadline) if spool_claimed else 0
+        
+        # دریافت پیام‌های ناموفق بدون lease فعال از shardها
+        query = getattr(req, 'query', None) or {}
+        if 'shard' in query:
+            shards = [int(query['shard']) % RECOVERY_SHARDS]
+        else:
+            first_shard = random.randrange(RECOVERY_SHARDS)
+            shards = [(first_shard + offset) % RECOVERY_SHARDS for offset in range(RECOVERY_SHARDS)]
+        
+        failed_messages = []
+        for shard in shards:
+            if len(failed_messages) >= RECOVERY_BATCH_SIZE:
+                break
+            try:
+                result = db_manager.execute_with_retry(
+                    'list_documents',
+                    database_id=APPWRITE_DATABASE_ID,
+                    collection_id=APPWRITE_FAILED_MESSAGES_COLLECTION_ID,
+                    queries=[
+                        f"shard={shard}",
+                        "retry_count<3",
+                        f"lease_expires_at<{time.time()}",
+                        "orderAsc('timestamp')",
+                        f"limit({RECOVERY_BATCH_SIZE - len(failed_messages)})"
+                    ],
+                    cache=False,
+                    deadline=deadline
+                )
+                failed_messages += result.get('documents', [])
+            except Exception as e:
+                # اگر Appwrite در دسترس نیست، فقط پیام‌های spool محلی پردازش می‌شوند
+                log_event('recovery.list_failed', level='warning', shard=shard, error=str(e))
+                break
         
-        failed_messages = result.get('documents', [])
-        processed_count = 0
+        pending_messages = [
+            {
+                'source': 'appwrite',
+                'id': message_doc['$id'],
+                'document': message_doc,
+                'chat_id': message_doc.get('chat_id'),
+                'message_data': message_doc.get('message_data'),
+                'retry_count': message_doc.get('retry_count', 0)
+            }
+            for message_doc in failed_messages
+        ]
+        if spool_claimed:
+            pending_messages += [
+                {
+                    'source': 'spool',
+                    'id': record['spool_id'],
+                    'chat_id': record.get('chat_id'),
+                    'message_data': record.get('message_data'),
+                    'retry_count': record.get('retry_count', 0)
+                }
+                for record in failed_message_spool.read_all()
+                if record.get('retry_count', 0) < 3
+            ][:RECOVERY_BATCH_SIZE]
+        
+        # عملیات دیتابیس هر پیام جمع‌آوری و در پایان به صورت گروهی اجرا می‌شوند
+        db_operations = []
+        delete_indexes = []
+        recovered_spool_ids = []
+        spool_updates = {}
+        skipped_count = 0
         
-        for message_doc in failed_messages:
+        for pending in pending_messages:
+            # پیام‌های باقی‌مانده در اجرای بعدی بازیابی می‌شوند
+            if deadline.expired():
+                log_event('recovery.deadline_reached', level='warning')
+                break
+            
+            log_token = bind_log_context(
+                chat_id=pending['chat_id'],
+                failed_message_id=pending['id'],
+                source=pending['source']
+            )
+            lease = None
             try:
-                message_id = message_doc['$id']
-                chat_id = message_doc['chat_id']
-                message_data = json.loads(message_doc['message_data'])
-                retry_count = message_doc.get('retry_count', 0)
+                message_id = pending['id']
+                message_data = json.loads(pending['message_data'])
+                retry_count = pending['retry_count']
+                
+                if pending['source'] == 'appwrite':
+                    lease = RecoveryLease.try_acquire(
+                        db_manager, pending['document'], owner, RECOVERY_LEASE_TTL, deadline
+                    )
+                    if lease is None:
+                        skipped_count += 1  # نمونه دیگری این پیام را پردازش می‌کند
+                        continue
                 
                 # تلاش مجدد برای پردازش
                 fake_update = {'message': message_data}
-                result = await process_message_immediately(fake_update)
+                result = await process_message_immediately(fake_update, deadline)
                 
+                send_success = False
                 if result['success']:
+                    if lease is not None:
+                        # پردازش ممکن است طولانی شده باشد؛ بدون lease معتبر پاسخ ارسال نمی‌شود
+                        lease.renew_if_needed(deadline)
                     # ارسال پاسخ
-                    send_success = await send_telegram_message_async(result['chat_id'], result['response'])
+                    send_success = await send_telegram_message_async(result['chat_id'], result['response'], deadline)
+                
+                if send_success:
+                    # ذخیره مکالمه
+                    db_operations.append(('create_document', {
+                        'database_id': APPWRITE_DATABASE_ID,
+                        'collection_id': APPWRITE_COLLECTION_ID,
+                        'document_id': 'unique()',
+                        'data': {
+                            'user_id': result['chat_id'],
+                            'message': result['message_data'].get('text', '[Recovered Message]'),
+                            'response': result['response'],
+                            'timestamp': {'$createdAt': True}
+                        }
+                    }))
                     
-                    if send_success:
-                        # ذخیره مکالمه
-                        await save_conversation_async(
-                            result['chat_id'],
-                            result['message_data'].get('text', '[Recovered Message]'),
-                            result['response']
-                        )
-                        
-                        # حذف از failed messages
-                        db_manager.execute_with_retry(
-                            'delete_document',
-                            database_id=APPWRITE_DATABASE_ID,
-                            collection_id=APPWRITE_FAILED_MESSAGES_COLLECTION_ID,
-                            document_id=message_id
-                        )
-                        
-                        processed_count += 1
+                    # حذف از failed messages
+                    if pending['source'] == 'spool':
+                        recovered_spool_ids.append(message_id)
                     else:
-                        # افزایش تعداد تلاش
-                        db_manager.execute_with_retry(
-                            'update_document',
-                            database_id=APPWRITE_DATABASE_ID,
-                            collection_id=APPWRITE_FAILED_MESSAGES_COLLECTION_ID,
-                            document_id=message_id,
-                            data={'retry_count': retry_count + 1}
-                        )
+                        delete_indexes.append(len(db_operations))
+                        db_operations.append(('delete_document', {
+                            'database_id': APPWRITE_DATABASE_ID,
+                            'collection_id': APPWRITE_FAILED_MESSAGES_COLLECTION_ID,
+                            'document_id': message_id
+                        }))
+                        db_operations.append(lease.claim_delete_operation())
+                elif pending['source'] == 'spool':
+                    spool_updates[message_id] = {'retry_count': retry_count + 1}
                 else:
-                    # افزایش تعداد تلاش
-                    db_manager.execute_with_retry(
-                        'update_document',
-                        database_id=APPWRITE_DATABASE_ID,
-                        collection_id=APPWRITE_FAILED_MESSAGES_COLLECTION_ID,
-                        document_id=message_id,
-                        data={'retry_count': retry_count + 1}
-                    )
+                    # افزایش تعداد تلاش و آزاد کردن lease
+                    db_operations += lease.release_operations({'retry_count': retry_count + 1})
+                lease = None
                     
+            except RecoveryLeaseLost as e:
+                lease = None  # نمونه دیگری ممکن است lease را گرفته باشد؛ به سند دست نمی‌زنیم
+                log_event('recovery.lease_lost', level='warning', document_id=pending['id'], error=str(e))
             except Exception as e:
-                print(f"خطا در بازیابی پیام {message_doc.get('$id', 'unknown')}: {e}")
+                log_event('recovery.message_failed', level='error', document_id=pending['id'], error=str(e))
+            finally:
+                if lease is not None:
+                    db_operations += lease.release_operations()
+                reset_log_context(log_token)
+        
+        # پیام‌های spool بلافاصله به‌روزرسانی می‌شوند تا دوباره ارسال نشوند
+        failed_message_spool.remove(recovered_spool_ids)
+        failed_message_spool.update(spool_updates)
+        
+        results = await db_manager.execute_many_async(db_operations, deadline=deadline.for_failure_path())
+        for (operation, kwargs), item in zip(db_operations, results):
+            if not item['success']:
+                log_event('recovery.db_operation_failed', level='error', operation=operation,
+                          document_id=kwargs['document_id'], error=str(item['error']))
+        
+        processed_count = len(recovered_spool_ids)
+        processed_count += sum(1 for index in delete_indexes if results[index]['success'])
         
         return res.json({
             "success": True,
             "processed_count": processed_count,
-            "total_failed_messages": len(failed_messages)
+            "total_failed_messages": len(pending_messages),
+            "skipped_leased": skipped_count,
+            "drained_from_spool": drained_count
         })
         
     except Exception as e:
-        print(f"خطا در تابع بازیابی: {str(e)}")
+        log_event('recovery.failed', level='error', error=str(e))
         return res.json({"success": False, "error": str(e)})
+    
+    finally:
+        if spool_claimed:
+            _spool_recovery_lock.release()
+
+async def compaction_function(req, res, deadline: Optional[Deadline] = None):
+    """فشرده‌سازی تاریخچه مکالمات (برای اجرای زمان‌بندی شده در ساعات کم‌ترافیک)"""
+    if deadline is None:
+        deadline = Deadline(REQUEST_DEADLINE, reserve=FAILURE_PATH_RESERVE)
+    
+    # در صورت وجود کار تعاملی در صف، ظرفیت Gemini صرف خلاصه‌سازی نمی‌شود
+    scheduler_stats = gemini_scheduler.get_stats()
+    if scheduler_stats['lanes']['interactive']['queue_depth'] or scheduler_stats['active']:
+        return res.json({"success": True, "skipped": "busy", "gemini_scheduler": scheduler_stats})
+    
+    try:
+        stats = await compact_conversation_history(summarize_conversation_async, deadline=deadline)
+        return res.json({"success": True, **stats})
+    except Exception as e:
+        log_event('compaction.failed', level='error', error=str(e))
+        return res.json({"success": False, "error": str(e)})
+
+def debug_profile_function(req, res, deadline: Optional[Deadline] = None):
+    """پروفایل‌گیری روی نمونه گرم (فقط با هدر x-debug-token معتبر)
+    
+    پارامترهای query: mode (cpu، tasks یا memory)، duration (ثانیه) و top
+    """
+    token = (req.headers or {}).get('x-debug-token', '')
+    if not DEBUG_PROFILE_TOKEN or not hmac.compare_digest(token.encode('utf-8'), DEBUG_PROFILE_TOKEN.encode('utf-8')):
+        return res.json({"error": "دسترسی غیرمجاز"}, 403)
+    
+    query = req.query or {}
+    try:
+        duration = float(query.get('duration', 5))
+        if deadline is not None:
+            duration = min(duration, deadline.remaining())
+        report = run_profile(query.get('mode', 'cpu'), duration, top=int(query.get('top', 20)))
+    except ValueError as e:
+        return res.json({"error": str(e)}, 400)
+    except RuntimeError as e:
+        return res.json({"error": str(e)}, 409)
+    
+    log_event('debug.profile', mode=report['mode'], duration=duration)
+    return res.json(report)
 
 # تابع بررسی سلامت سیستم
 def health_check_function(req, res):
@@ -646,6 +1674,13 @@ def health_check_function(req, res):
             "database_health": db_health,
             "telegram_health": telegram_health,
             "gemini_health": gemini_health,
+            "database_pool": db_manager.get_connection_stats(),
+            "logging": get_log_stats(),
+            "spooled_failed_messages": failed_message_spool.count(),
+            "gemini_scheduler": gemini_scheduler.get_stats(),
+            "admission": admission_controller.get_stats(),
+            "gemini_prompt_cache": gemini_prompt_cache.get_stats(),
+            "cpu_pool": cpu_pool.get_stats(),
             "timestamp": time.time()
         })
         
@@ -660,26 +1695,54 @@ def health_check_function(req, res):
 def main(req, res):
     """نقطه ورودی اصلی برای فانکشن Appwrite"""
     
-    # تعیین نوع عملیات بر اساس path و method
-    if req.method == 'POST' and req.path in ['/', '/webhook']:
-        # پردازش webhook تلگرام
-        return asyncio.run(main_webhook_realtime(req, res))
+    # یک بودجه زمانی واحد برای کل درخواست که به تمام مراحل منتقل می‌شود
+    deadline = Deadline(REQUEST_DEADLINE, reserve=FAILURE_PATH_RESERVE)
     
-    elif req.method == 'GET' and req.path == '/recovery':
-        # پردازش پیام‌های ناموفق
-        return asyncio.run(recovery_function(req, res))
+    # راه‌اندازی workerهای process pool در پس‌زمینه (فقط در اولین invocation نمونه گرم)
+    cpu_pool.warm_up()
     
-    elif req.method == 'GET' and req.path == '/health':
-        # بررسی سلامت سیستم
-        return health_check_function(req, res)
+    try:
+        # تعیین نوع عملیات بر اساس path و method
+        if req.method == 'POST' and req.path in ['/', '/webhook']:
+            # کنترل پذیرش: در زمان بار زیاد پاسخ سریع بدون پردازش کامل
+            shed_reason = admission_controller.try_admit()
+            if shed_reason is not None:
+                return asyncio.run(track_event_loop(shed_webhook_request(req, res, shed_reason, deadline)))
+            
+            # پردازش webhook تلگرام
+            try:
+                return asyncio.run(track_event_loop(main_webhook_realtime(req, res, deadline)))
+            finally:
+                admission_controller.release()
+        
+        elif req.method == 'GET' and req.path == '/recovery':
+            # پردازش پیام‌های ناموفق
+            return asyncio.run(track_event_loop(recovery_function(req, res, deadline)))
+        
+        elif req.method == 'GET' and req.path == '/compaction':
+            # فشرده‌سازی تاریخچه مکالمات
+            return asyncio.run(track_event_loop(compaction_function(req, res, deadline)))
+        
+        elif req.method == 'GET' and req.path == '/health':
+            # بررسی سلامت سیستم
+            return health_check_function(req, res)
+        
+        elif req.method == 'GET' and req.path == '/debug/profile':
+            # پروفایل‌گیری روی نمونه گرم
+            return debug_profile_function(req, res, deadline)
+        
+        else:
+            return res.json({
+                "error": "درخواست نامعتبر",
+                "supported_endpoints": {
+                    "POST /webhook": "پردازش پیام‌های تلگرام",
+                    "GET /recovery": "بازیابی پیام‌های ناموفق",
+                    "GET /compaction": "فشرده‌سازی تاریخچه مکالمات",
+                    "GET /health": "بررسی سلامت سیستم"
+                }
+            }, 400)
     
-    else:
-        return res.json({
-            "error": "درخواست نامعتبر",
-            "supported_endpoints": {
-                "POST /webhook": "پردازش پیام‌های تلگرام",
-                "GET /recovery": "بازیابی پیام‌های ناموفق",
-                "GET /health": "بررسی سلامت سیستم"
-            }
-        }, 400)
-
+    finally:
+        # رکوردهای spool و لاگ‌های صف قبل از پایان invocation روی دیسک/خروجی نوشته می‌شوند
+        failed_message_spool.flush()
+        flush_logs()
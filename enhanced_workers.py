@@ -0,0 +1,152 @@
+import ast
+import asyncio
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Any, Dict, Optional
+
+# تنظیمات process pool برای مراحل CPU-bound پردازش پیام
+CPU_POOL_WORKERS = 2  # 0 یعنی اجرای inline بدون process pool
+SHARED_MEMORY_MIN_BYTES = 64 * 1024  # فایل‌های کوچک‌تر مستقیماً (pickle) به worker ارسال می‌شوند
+
+
+def _init_worker():
+    """بارگذاری پروفایل‌های langdetect یک‌بار در هر worker (نه در هر پیام)"""
+    import langdetect
+    try:
+        langdetect.detect("warm up language profiles")
+    except Exception:
+        pass
+
+
+def _warm_worker():
+    return True
+
+
+def detect_language(text: str) -> str:
+    """تشخیص زبان متن (در صورت خطا 'en')"""
+    import langdetect
+    try:
+        return langdetect.detect(text) if text else 'en'
+    except Exception:
+        return 'en'
+
+
+def find_syntax_error(data) -> Optional[str]:
+    """بررسی syntax فایل Python؛ توضیح خطا یا None
+
+    فقط همین نتیجه کوتاه به process اصلی برمی‌گردد (متن فایل همان‌جا decode می‌شود).
+    """
+    try:
+        ast.parse(str(data, 'utf-8'))
+    except SyntaxError as e:
+        return f"line {e.lineno}: {e.msg}"
+    return None
+
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # پایتون قدیمی‌تر از 3.13
+        return shared_memory.SharedMemory(name=name)
+
+
+def _find_syntax_error_shared(name: str, size: int) -> Optional[str]:
+    """بررسی syntax مستقیماً از shared memory بدون کپی بایت‌ها در pipe بین processها"""
+    shm = _attach_shared_memory(name)
+    view = shm.buf[:size]
+    try:
+        return find_syntax_error(view)
+    finally:
+        view.release()
+        shm.close()
+
+
+class CpuWorkerPool:
+    """process pool برای مراحل CPU-bound (تشخیص زبان و بررسی syntax فایل‌ها)
+
+    workerها با forkserver (یا spawn) ساخته می‌شوند و پروفایل‌های langdetect را در
+    initializer یک‌بار بارگذاری می‌کنند؛ warm_up آن‌ها را پیش از اولین پیام راه‌اندازی
+    می‌کند. بایت‌های فایل‌های بزرگ از طریق shared memory منتقل می‌شوند. با
+    max_workers=0 یا خراب شدن pool، همان توابع inline اجرا می‌شوند.
+    """
+
+    def __init__(self, max_workers=2, shared_memory_min_bytes=64 * 1024):
+        self.max_workers = max_workers
+        self.shared_memory_min_bytes = shared_memory_min_bytes
+        self._executor = None
+        self._warmed = False
+        self._lock = threading.Lock()
+        self._stats = {'pooled': 0, 'inline': 0, 'shared_memory': 0, 'restarts': 0}
+
+    def _get_executor(self):
+        # workerها ماژول اصلی را دوباره import می‌کنند؛ داخل آن‌ها pool جدیدی ساخته نمی‌شود
+        if self.max_workers <= 0 or multiprocessing.parent_process() is not None:
+            return None
+
+        with self._lock:
+            if self._executor is None:
+                start_methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in start_methods else 'spawn')
+                if context.get_start_method() == 'forkserver':
+                    context.set_forkserver_preload([__name__])
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=context,
+                    initializer=_init_worker
+                )
+            return self._executor
+
+    def warm_up(self):
+        """راه‌اندازی تمام workerها در پس‌زمینه (بدون انتظار؛ فقط بار اول اثر دارد)"""
+        if self._warmed:
+            return
+        executor = self._get_executor()
+        if executor is not None:
+            self._warmed = True
+            for _ in range(self.max_workers):
+                executor.submit(_warm_worker)
+
+    async def run(self, func, *args):
+        """اجرای یک تابع سطح ماژول در process pool"""
+        executor = self._get_executor()
+        if executor is None:
+            self._stats['inline'] += 1
+            return func(*args)
+
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+            self._stats['pooled'] += 1
+            return result
+        except BrokenProcessPool:
+            # یک worker از کار افتاده است؛ pool در فراخوانی بعدی از نو ساخته می‌شود
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+                    self._warmed = False
+                    self._stats['restarts'] += 1
+            executor.shutdown(wait=False)
+            self._stats['inline'] += 1
+            return func(*args)
+
+    async def detect_language(self, text: str) -> str:
+        return await self.run(detect_language, text)
+
+    async def find_syntax_error(self, data: bytes) -> Optional[str]:
+        """بررسی syntax فایل؛ فایل‌های بزرگ از طریق shared memory منتقل می‌شوند"""
+        if self.max_workers <= 0 or len(data) < self.shared_memory_min_bytes:
+            return await self.run(find_syntax_error, data)
+
+        shm = shared_memory.SharedMemory(create=True, size=len(data))
+        try:
+            shm.buf[:len(data)] = data
+            self._stats['shared_memory'] += 1
+            return await self.run(_find_syntax_error_shared, shm.name, len(data))
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {'workers': self.max_workers, 'started': self._executor is not None, **self._stats}